@@ -0,0 +1,50 @@
+'''
+Admin endpoints for operators, eg. the request profiles kept by diagnostics.profiler
+and the slow query log kept by diagnostics.slow_queries.
+Every endpoint needs the X-Admin-Token header to match ADMIN_TOKEN; with
+ADMIN_TOKEN unset they are all refused.
+'''
+import hmac
+import os
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from diagnostics import profiler, slow_queries
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/profiles")
+async def list_profiles():
+    '''
+    The slowest recently profiled requests, slowest first.
+    '''
+    return {"profiles": [profile.summary() for profile in profiler.sampler.profiles()]}
+
+
+@router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+async def get_profile(profile_id: int):
+    '''
+    One profile as folded stacks, for flamegraph.pl or speedscope.
+    '''
+    profile = profiler.sampler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(profile.folded())
+
+
+@router.get("/slow-queries")
+async def list_slow_queries(limit: Optional[int] = None):
+    '''
+    Statements over SLOW_QUERY_MS, newest first, with their EXPLAIN plans once captured.
+    '''
+    return {"threshold_ms": slow_queries.SLOW_QUERY_MS, "queries": slow_queries.entries(limit)}
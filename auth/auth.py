@@ -1,5 +1,7 @@
 """
 Authentication module for FastAPI application.
+passlib (bcrypt) and jose are imported on first use, so workers that never
+authenticate a request don't pay for them at startup.
 """
 
 from typing import List
@@ -7,33 +9,44 @@ from datetime import datetime, timedelta, timezone
 from fastapi import APIRouter, HTTPException, status, Response, Request
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.future import select
-from passlib.context import CryptContext
+from sqlalchemy import delete
 from database import database
-from jose import JWTError, jwt
 from typing import List
+import functools
+import os
+import secrets
 import xrpledger.smart_contracts as xrp
 from database import database
+from auth import revocation
 
 # Constants
 # TODO: REPLACE WITH ENV VARS
 SECRET_KEY = "testkey"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 5
+# a login session can be renewed for this long, then the user has to log in again
+SESSION_MAX_AGE_HOURS = int(os.getenv("SESSION_MAX_AGE_HOURS", "168"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 router = APIRouter()
 
 # Convenience helpers
 
+@functools.lru_cache(maxsize=None)
+def get_pwd_context():
+    """Builds the bcrypt password context on first use."""
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
 def hash_password(password: str) -> str:
     """Hashes a password using bcrypt."""
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifies a password against a hashed password."""
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -41,6 +54,8 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     Creates an access token with an expiration time and
     associates it with the http response object.
     """
+    from jose import jwt
+
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (
         expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -49,12 +64,40 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def session_claims(payload: dict) -> dict:
+    """
+    The claims a renewed token carries over from the one it replaces.
+    """
+    return {"sub": payload["sub"], "sid": payload["sid"], "session_exp": payload["session_exp"]}
+
+
+def check_session(payload: dict):
+    """
+    Rejects tokens of revoked or expired sessions, and tokens issued without a session.
+    One set lookup, no I/O.
+    """
+    if "sid" not in payload or "session_exp" not in payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
+        )
+    if revocation.revoked.is_revoked(payload["sid"]):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Session has been revoked"
+        )
+    if datetime.now(timezone.utc).timestamp() > payload["session_exp"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Session has expired"
+        )
+
+
 def check_and_renew_access_token(request: Request, response: Response):
     """
     Checks access token for validity, and renews if it is within timeout.
     Otherwise, raises an exception.
     Should run first on all protected routes.
     """
+    from jose import JWTError, jwt
+
     token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(
@@ -62,11 +105,12 @@ def check_and_renew_access_token(request: Request, response: Response):
         )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        check_session(payload)
         if datetime.now(timezone.utc) < datetime.fromtimestamp(
             payload["exp"], timezone.utc
         ):
             # renew token within timeout
-            access_token = create_access_token({"sub": payload["sub"]})
+            access_token = create_access_token(session_claims(payload))
             response.set_cookie(
                 key="access_token",
                 value=access_token,
@@ -91,6 +135,8 @@ def check_and_renew_access_token(request: Request, response: Response):
 
 def get_current_user(request: Request):
     """Retrieves the current user from the request."""
+    from jose import JWTError, jwt
+
     token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(
@@ -98,6 +144,7 @@ def get_current_user(request: Request):
         )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        check_session(payload)
         return payload
     except JWTError:
         raise HTTPException(
@@ -155,7 +202,17 @@ async def login(user: str, password: str, response: Response):
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials"
         )
 
-    access_token = create_access_token({"sub": user.user_id})
+    session_id = secrets.token_urlsafe(16)
+    session_expires = datetime.now(timezone.utc) + timedelta(hours=SESSION_MAX_AGE_HOURS)
+    async with database.AsyncSessionLocalFactory() as session:
+        session.add(database.UserSession(
+            session_id=session_id, user_id=user.user_id, expires_at=session_expires
+        ))
+        await session.commit()
+
+    access_token = create_access_token({
+        "sub": user.user_id, "sid": session_id, "session_exp": int(session_expires.timestamp())
+    })
     response.set_cookie(
         key="access_token",
         value=access_token,
@@ -167,15 +224,60 @@ async def login(user: str, password: str, response: Response):
 
 
 @router.post("/logout", tags=["Authentication"])
-async def logout(response: Response):
+async def logout(request: Request, response: Response):
     """
-    Logs out a user by deleting the access token cookie.
-    No HTTP request data to read.
+    Logs out a user by revoking their session and deleting the access token cookie.
+    Every token of the session stops working, including copies of it elsewhere.
     """
+    from jose import JWTError, jwt
+
+    token = request.cookies.get("access_token")
+    try:
+        # an expired token can still end its session
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False}) if token else {}
+    except JWTError:
+        payload = {}
+
+    if "sid" in payload and "session_exp" in payload:
+        async with database.AsyncSessionLocalFactory() as session:
+            await revocation.revoke(session, payload["sub"], {
+                payload["sid"]: datetime.fromtimestamp(payload["session_exp"], timezone.utc)
+            })
+            await session.execute(
+                delete(database.UserSession).where(database.UserSession.session_id == payload["sid"])
+            )
+            await session.commit()
+        # this worker doesn't wait for the notification
+        revocation.revoked.add(payload["sid"])
+
     response.delete_cookie("access_token")
     return {"message": "Logged out successfully"}
 
 
+@router.post("/logout-all", tags=["Authentication"])
+async def logout_all(request: Request, response: Response):
+    """
+    Logs a user out everywhere, revoking every one of their sessions.
+    """
+    payload = check_and_renew_access_token(request, response)
+    user = payload["sub"]
+    async with database.AsyncSessionLocalFactory() as session:
+        sessions = await session.execute(
+            delete(database.UserSession)
+            .where(database.UserSession.user_id == user)
+            .returning(database.UserSession.session_id, database.UserSession.expires_at)
+        )
+        revoked = {session_id: expires_at for session_id, expires_at in sessions.all()}
+        revoked[payload["sid"]] = datetime.fromtimestamp(payload["session_exp"], timezone.utc)
+        await revocation.revoke(session, user, revoked)
+        await session.commit()
+    for session_id in revoked:
+        revocation.revoked.add(session_id)
+
+    response.delete_cookie("access_token")
+    return {"message": "Logged out of all sessions", "sessions_revoked": len(revoked)}
+
+
 @router.get("/me", tags=["Authentication"])
 async def get_me(request: Request, response: Response):
     """
@@ -0,0 +1,164 @@
+"""
+Token revocation for the auth dependency.
+
+Every access token carries a session id (sid) that renewals keep, and that is
+what gets revoked. Logging out revokes the session, which rejects every token it
+was ever renewed into, stolen copies included.
+
+Revoked ids live in the revoked_tokens table. Each worker holds the ids that have
+not expired yet in a set, so checking a token is one set lookup and no I/O.
+The set only ever holds revoked ids, not issued ones, and rows drop out once
+their session would have expired anyway, so it stays small however many tokens
+are issued. Revocations reach every worker straight away through pg_notify, and
+each worker reloads the whole set every REVOCATION_SYNC_SECONDS in case it
+missed a notification.
+"""
+
+import asyncio
+import os
+from datetime import datetime, timezone
+from sqlalchemy import delete, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from database import database
+
+REVOCATION_CHANNEL = "token_revocations"
+REVOCATION_PRUNE_LOCK_NAME = "auth.revocation.prune"
+
+# how often each worker reloads the revoked ids and expired rows are pruned
+REVOCATION_SYNC_SECONDS = int(os.getenv("REVOCATION_SYNC_SECONDS", "60"))
+
+
+class RevokedIds:
+    """
+    This worker's copy of the revoked ids.
+    """
+    def __init__(self):
+        self.revoked = set()
+        # ids notified while a reload is running, so the reload can't drop them
+        self.notified = None
+
+    def is_revoked(self, session_id: str) -> bool:
+        return session_id in self.revoked
+
+    def add(self, token_id: str):
+        self.revoked.add(token_id)
+        if self.notified is not None:
+            self.notified.add(token_id)
+
+    def start_reload(self):
+        self.notified = set()
+
+    def finish_reload(self, token_ids: set):
+        # swapped in whole, readers never see a half built set
+        self.revoked = token_ids | self.notified
+        self.notified = None
+
+
+revoked = RevokedIds()
+# the listener and the periodic sync both reload
+_reload_lock = asyncio.Lock()
+
+
+async def revoke(session, user_id: str, token_ids: dict):
+    """
+    Revokes ids ({token_id: when its tokens expire anyway}) in the session's transaction.
+    Every worker picks them up once it commits.
+    """
+    if not token_ids:
+        return
+    await session.execute(
+        insert(database.RevokedToken)
+        .values([
+            {"token_id": token_id, "user_id": user_id, "expires_at": expires_at}
+            for token_id, expires_at in token_ids.items()
+        ])
+        .on_conflict_do_nothing(index_elements=["token_id"])
+    )
+    for token_id in token_ids:
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": REVOCATION_CHANNEL, "payload": token_id}
+        )
+
+
+async def load_revoked():
+    """
+    Reloads every revoked id that has not expired.
+    """
+    async with _reload_lock:
+        revoked.start_reload()
+        try:
+            async with database.AsyncSessionLocalFactory() as session:
+                token_ids = await session.execute(
+                    select(database.RevokedToken.token_id).where(
+                        database.RevokedToken.expires_at > datetime.now(timezone.utc)
+                    )
+                )
+                token_ids = set(token_ids.scalars().all())
+        except BaseException:
+            revoked.notified = None
+            raise
+        revoked.finish_reload(token_ids)
+
+
+async def prune_expired():
+    """
+    Deletes revocations and sessions past their expiry, from one worker at a time.
+    """
+    async with database.advisory_lock(REVOCATION_PRUNE_LOCK_NAME) as acquired:
+        if not acquired:
+            return
+        now = datetime.now(timezone.utc)
+        async with database.AsyncSessionLocalFactory() as session:
+            await session.execute(delete(database.RevokedToken).where(database.RevokedToken.expires_at < now))
+            await session.execute(delete(database.UserSession).where(database.UserSession.expires_at < now))
+            await session.commit()
+
+
+def _on_notification(connection, pid, channel, payload):
+    revoked.add(payload)
+
+
+async def listen_for_revocations():
+    """
+    Adds revocations from every worker as they commit.
+    Reconnects if the listening connection drops, and reloads in case any were missed.
+    """
+    while True:
+        try:
+            async with database.engine.connect() as conn:
+                raw_connection = await conn.get_raw_connection()
+                listener = raw_connection.driver_connection
+                await listener.add_listener(REVOCATION_CHANNEL, _on_notification)
+                try:
+                    await load_revoked()
+                    while not listener.is_closed():
+                        await asyncio.sleep(5)
+                finally:
+                    if not listener.is_closed():
+                        await listener.remove_listener(REVOCATION_CHANNEL, _on_notification)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Revocation listener failed: {e}")
+        await asyncio.sleep(5)
+
+
+async def run_revocation_sync():
+    """
+    Keeps this worker's revoked ids in sync: listens for new revocations, and
+    reloads / prunes every REVOCATION_SYNC_SECONDS.
+    """
+    listener = asyncio.create_task(listen_for_revocations())
+    try:
+        while True:
+            await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+            try:
+                await load_revoked()
+                await prune_expired()
+            except Exception as e:
+                print(f"Revocation sync failed: {e}")
+    finally:
+        listener.cancel()
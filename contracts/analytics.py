@@ -0,0 +1,93 @@
+'''
+Courier performance analytics.
+
+courier_stats keeps running totals per courier, updated inside the same
+transaction that settles or fails a contract. Reading a courier's reputation
+is a single primary key lookup, no matter how many contracts they delivered.
+'''
+from collections import Counter
+from sqlalchemy.dialects.postgresql import insert
+
+from database import database
+
+# Columns to select (or join) for a CourierStatsOut
+COURIER_STATS_COLUMNS = (
+    database.CourierStats.courier_id,
+    database.CourierStats.contracts_completed,
+    database.CourierStats.contracts_failed,
+    database.CourierStats.contracts_on_time,
+    database.CourierStats.total_drop_alerts,
+    database.CourierStats.total_overtemp_alerts,
+    database.CourierStats.total_water_events,
+)
+
+COUNTERS = [column.key for column in COURIER_STATS_COLUMNS[1:]]
+
+
+def _increment(rows: list):
+    '''
+    Upsert that adds each row's counts to that courier's running totals.
+    '''
+    statement = insert(database.CourierStats).values([
+        {**{counter: 0 for counter in COUNTERS}, **counts} for counts in rows
+    ])
+    return statement.on_conflict_do_update(
+        index_elements=[database.CourierStats.courier_id],
+        set_={
+            counter: getattr(database.CourierStats, counter) + getattr(statement.excluded, counter)
+            for counter in COUNTERS
+        }
+    )
+
+
+async def record_completion(session, contract: database.Contract, sensor_data: database.SensorData):
+    '''
+    Adds a settled contract to its courier's totals.
+    Must run in the settlement transaction, before the sensor data is wiped.
+    '''
+    on_time = (
+        contract.contract_completion_time is not None and
+        contract.contract_timeout is not None and
+        contract.contract_completion_time <= contract.contract_timeout
+    )
+    await session.execute(_increment([{
+        "courier_id": contract.courier_id,
+        "contracts_completed": 1,
+        "contracts_on_time": 1 if on_time else 0,
+        "total_drop_alerts": sensor_data.drop_alerts if sensor_data else 0,
+        "total_overtemp_alerts": sensor_data.overtemp_alerts if sensor_data else 0,
+        "total_water_events": sensor_data.water_events if sensor_data else 0,
+    }]))
+
+
+async def record_failures(session, courier_ids: list):
+    '''
+    Adds failed contracts to their couriers' totals in a single upsert.
+    '''
+    rows = [
+        {"courier_id": courier_id, "contracts_failed": failed}
+        for courier_id, failed in Counter(courier_ids).items() if courier_id is not None
+    ]
+    if rows:
+        await session.execute(_increment(rows))
+
+
+def stats_from_row(row) -> dict:
+    '''
+    Builds the courier stats payload from a row of COURIER_STATS_COLUMNS.
+    Returns None if the courier has no history yet.
+    '''
+    courier_id, completed, failed, on_time, drops, overtemps, water = row
+    if courier_id is None:
+        return None
+    finished = completed + failed
+    return {
+        "courier_id": courier_id,
+        "contracts_completed": completed,
+        "contracts_failed": failed,
+        "completion_rate": completed / finished if finished else None,
+        "on_time_ratio": on_time / completed if completed else None,
+        "avg_drop_alerts": drops / completed if completed else None,
+        "avg_overtemp_alerts": overtemps / completed if completed else None,
+        "avg_water_events": water / completed if completed else None,
+    }
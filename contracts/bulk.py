@@ -0,0 +1,168 @@
+'''
+Bulk contract creation and updates.
+
+Bodies are a JSON list or a CSV file (Content-Type: text/csv) with one contract
+per row, using the same field names as the single contract endpoints. Every row
+is validated before anything is written, then all rows go to the database in a
+single statement.
+'''
+import csv
+import io
+import json
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import Request
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, ValidationError, field_validator
+from sqlalchemy import insert, update, values, column, func, cast, Integer, Float, String, TIMESTAMP
+
+from database import database
+
+# asyncpg allows at most 32767 bind parameters per statement, a create row takes 9
+BULK_MAX_ROWS = 2000
+
+
+def parse_timeout(value):
+    '''
+    Parses a timeout in "%Y-%m-%dT%H:%M:%S" format, as UTC.
+    '''
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+
+
+class ContractIn(BaseModel):
+    '''
+    One row of a bulk create, same fields as /create-contract.
+    '''
+    title: str
+    desc: str
+    required_completion_time: datetime
+    collateral: int
+    base_price: int
+    t1_incentive: int
+    t2_incentive: int
+
+    _parse_timeout = field_validator("required_completion_time", mode="before")(parse_timeout)
+
+
+class ContractUpdateIn(BaseModel):
+    '''
+    One row of a bulk update, same fields as /update-contract.
+    Fields left out (or empty in a CSV) keep their current value.
+    '''
+    contract_id: int
+    new_base_price: Optional[int] = None
+    new_collateral: Optional[int] = None
+    new_t1_incentive: Optional[int] = None
+    new_t2_incentive: Optional[int] = None
+    new_timeout: Optional[datetime] = None
+    new_title: Optional[str] = None
+    new_desc: Optional[str] = None
+
+    _parse_timeout = field_validator("new_timeout", mode="before")(parse_timeout)
+
+
+async def parse_rows(request: Request, model) -> list:
+    '''
+    Reads a JSON list or CSV body and validates every row against model.
+    Raises 422 with the errors of every bad row, so nothing is written unless all rows are valid.
+    '''
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.startswith("text/csv"):
+            rows = [
+                # empty CSV cells mean "not given"
+                {key: value for key, value in row.items() if value != ""}
+                for row in csv.DictReader(io.StringIO(body.decode("utf-8")))
+            ]
+        else:
+            rows = json.loads(body)
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse body: {str(e)}")
+
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Body must be a list of contracts")
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ROWS} contracts per request")
+
+    parsed = []
+    errors = []
+    for idx, row in enumerate(rows):
+        try:
+            parsed.append(model.model_validate(row))
+        except ValidationError as e:
+            errors.append({"row": idx, "errors": e.errors(include_url=False, include_context=False)})
+        except (TypeError, ValueError) as e:
+            errors.append({"row": idx, "errors": [str(e)]})
+    if errors:
+        raise HTTPException(status_code=422, detail=errors)
+    return parsed
+
+
+def insert_contracts(user: str, contracts: list):
+    '''
+    One multi-row INSERT ... RETURNING for every contract, in row order.
+    '''
+    return insert(database.Contract).values([
+        {
+            "proposer_id": user,
+            "contract_timeout": contract.required_completion_time,
+            "contract_status": database.ContractStatus.OPEN.value,
+            "required_collateral": contract.collateral,
+            "base_price": contract.base_price,
+            "t1_bonus": contract.t1_incentive,
+            "t2_bonus": contract.t2_incentive,
+            "contract_title": contract.title,
+            "contract_description": contract.desc,
+        } for contract in contracts
+    ]).returning(database.Contract.contract_id, database.Contract.contract_title)
+
+
+def update_contracts(user: str, changes: list):
+    '''
+    One UPDATE ... FROM (VALUES ...) RETURNING for every change.
+    Only the user's OPEN contracts are touched, missing fields keep their value.
+    '''
+    changed = values(
+        column("contract_id", Integer),
+        column("base_price", Float),
+        column("required_collateral", Float),
+        column("t1_bonus", Float),
+        column("t2_bonus", Float),
+        column("contract_timeout", TIMESTAMP(timezone=True)),
+        column("contract_title", String),
+        column("contract_description", String),
+        name="changed",
+    ).data([
+        (
+            change.contract_id,
+            change.new_base_price,
+            change.new_collateral,
+            change.new_t1_incentive,
+            change.new_t2_incentive,
+            change.new_timeout,
+            change.new_title,
+            change.new_desc,
+        ) for change in changes
+    ])
+
+    return (
+        update(database.Contract)
+        .where(
+            database.Contract.contract_id == changed.c.contract_id,
+            database.Contract.proposer_id == user,
+            database.Contract.contract_status == database.ContractStatus.OPEN.value
+        )
+        .values(**{
+            # fields missing from every row come through VALUES as untyped NULLs (text), so cast them back
+            name: func.coalesce(cast(changed.c[name], changed.c[name].type), getattr(database.Contract, name))
+            for name in [
+                "base_price", "required_collateral", "t1_bonus", "t2_bonus",
+                "contract_timeout", "contract_title", "contract_description",
+            ]
+        })
+        .returning(database.Contract.contract_id)
+        .execution_options(synchronize_session=False)
+    )
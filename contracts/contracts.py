@@ -1,54 +1,44 @@
-from fastapi import APIRouter, Response, Request, Depends
+from fastapi import APIRouter, Response, Request, Depends, Header
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 from auth import auth
 from database import database
 from sqlalchemy.future import select
-from sqlalchemy import DateTime
+from sqlalchemy import DateTime, exists, insert, update
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timezone
-import pytz
-from typing import List
+from typing import List, Literal, Optional
 import xrpledger.smart_contracts as xrp
+from contracts import settlement
+from contracts import idempotency
+from contracts.schemas import ContractOut, CourierStatsOut, select_contracts, select_user_contracts, contract_response, contract_list_response
+from contracts import analytics
+from contracts import bulk
+from contracts import export
+from contracts import events
+from sensor import tracking
 
 router = APIRouter()
 
 # Routes
-@router.get("/open-contracts", tags=["Contracts"])
+@router.get("/open-contracts", tags=["Contracts"], response_model=List[ContractOut])
 async def get_open_contracts(
     request: Request, 
     response: Response,
     _auth: None=Depends(auth.check_and_renew_access_token)):
     '''
-    Returns a list of all open contracts in a compacted form.
-    Compacted == just ID and title.
+    Returns a list of all open contracts.
     '''
     async with database.AsyncSessionLocalFactory() as session:
         open_contracts = await session.execute(
-            select(database.Contract).where(
-                database.Contract.contract_status == database.ContractStatus.OPEN.value
+            select_contracts(courier_stats=False).where(
+                database.Contract.contract_status == database.ContractStatus.OPEN.value,
+                # the expiry sweeper may not have caught up yet
+                database.Contract.contract_timeout > datetime.now(timezone.utc)
             )
         )
 
-    open_contracts:List[database.Contract] = open_contracts.scalars().all()
-    compact_contracts = [
-        {
-            # "contract_id": contract.contract_id,
-            # "title": contract.contract_title,
-
-            "contract_id":  contract.contract_id,
-            "proposer_id":  contract.proposer_id,
-            "courier_id":   contract.courier_id,
-            "contract_award_time": contract.contract_award_time,
-            "contract_completion_time": contract.contract_completion_time,
-            "contract_timeout": contract.contract_timeout,
-            "contractStatus": contract.contract_status,
-            "required_collateral": contract.required_collateral,
-            "base_price": contract.base_price,
-            "t1_bonus": contract.t1_bonus,
-            "t2_bonus": contract.t2_bonus,
-            "title": contract.contract_title,
-            "description": contract.contract_description,
-        } for contract in open_contracts
-    ]
-    return compact_contracts
+    return contract_list_response(open_contracts.all(), response)
 
 @router.get("/my-contracts-all", tags=["Contracts", "Proposer", "Courier"])
 async def get_my_contracts(
@@ -90,7 +80,7 @@ async def get_my_contracts(
     ]
     return compact_contracts
 
-@router.get("/my-contract-requests", tags=["Contracts", "Proposer"])
+@router.get("/my-contract-requests", tags=["Contracts", "Proposer"], response_model=List[ContractOut])
 async def get_my_contract_requests(
     request: Request,
     response: Response,
@@ -103,33 +93,11 @@ async def get_my_contract_requests(
     user = auth.get_current_user(request)['sub']
     async with database.AsyncSessionLocalFactory() as session:
         user_contracts = await session.execute(
-            select(database.Contract).where(
-                (database.Contract.proposer_id == user)
-            )
+            select_user_contracts("proposer_id", user)
         )
-    user_contracts:List[database.Contract] = user_contracts.scalars().all()
-    compact_contracts = [
-        {
-            # "contract_id": contract.contract_id,
-            # "title": contract.contract_title,
-                        "contract_id":  contract.contract_id,
-            "proposer_id":  contract.proposer_id,
-            "courier_id":   contract.courier_id,
-            "contract_award_time": contract.contract_award_time,
-            "contract_completion_time": contract.contract_completion_time,
-            "contract_timeout": contract.contract_timeout,
-            "contractStatus": contract.contract_status,
-            "required_collateral": contract.required_collateral,
-            "base_price": contract.base_price,
-            "t1_bonus": contract.t1_bonus,
-            "t2_bonus": contract.t2_bonus,
-            "title": contract.contract_title,
-            "description": contract.contract_description,
-        } for contract in user_contracts
-    ]
-    return compact_contracts
+    return contract_list_response(user_contracts.all(), response)
 
-@router.get("/my-contract-deliveries", tags=["Contracts", "Courier"])
+@router.get("/my-contract-deliveries", tags=["Contracts", "Courier"], response_model=List[ContractOut])
 async def get_my_contract_deliveries(
     request: Request,
     response: Response,
@@ -137,41 +105,36 @@ async def get_my_contract_deliveries(
     '''
     Returns a list of all contracts the current user has accepted to deliver.
     ie.. Contracts that the user is the courier for.
-    Returns in compact form (ID, Title)
     '''
     user = auth.get_current_user(request)['sub']
 
     async with database.AsyncSessionLocalFactory() as session:
         user_deliveries = await session.execute(
-            select(database.Contract).where(
-                database.Contract.courier_id == user
-            )
+            select_user_contracts("courier_id", user)
         )
-        user_deliveries: List[database.Contract] = user_deliveries.scalars().all()
-
-        compact_bids = [
-            {
-            # "contract_id": contract.contract_id,
-            # "title": contract.contract_title,
-
-                        "contract_id":  contract.contract_id,
-            "proposer_id":  contract.proposer_id,
-            "courier_id":   contract.courier_id,
-            "contract_award_time": contract.contract_award_time,
-            "contract_completion_time": contract.contract_completion_time,
-            "contract_timeout": contract.contract_timeout,
-            "contractStatus": contract.contract_status,
-            "required_collateral": contract.required_collateral,
-            "base_price": contract.base_price,
-            "t1_bonus": contract.t1_bonus,
-            "t2_bonus": contract.t2_bonus,
-            "title": contract.contract_title,
-            "description": contract.contract_description,
+    return contract_list_response(user_deliveries.all(), response)
 
+@router.get("/couriers/{courier_id}/stats", tags=["Contracts", "Courier", "Proposer"], response_model=CourierStatsOut)
+async def get_courier_stats(
+    courier_id: str,
+    request: Request,
+    response: Response,
+    _auth: None=Depends(auth.check_and_renew_access_token)):
+    '''
+    Returns a courier's reputation: completion rate, on time ratio,
+    and average drop / overtemp / water alerts per delivery.
+    '''
+    async with database.AsyncSessionLocalFactory() as session:
+        courier_stats = await session.execute(
+            select(*analytics.COURIER_STATS_COLUMNS).where(
+                database.CourierStats.courier_id == courier_id
+            )
+        )
+        courier_stats = courier_stats.first()
 
-            } for contract in user_deliveries
-        ]
-    return compact_bids
+    if not courier_stats:
+        raise HTTPException(status_code=404, detail="No delivery history for this courier")
+    return analytics.stats_from_row(courier_stats)
 
 @router.post("/create-contract", tags=["Contracts", "Proposer"])
 async def create_contract(
@@ -198,7 +161,7 @@ async def create_contract(
             "%Y-%m-%dT%H:%M:%S"
         )
         required_completion_time = required_completion_time.replace(
-            tzinfo=pytz.utc
+            tzinfo=timezone.utc
         ) # Set timezone to UTC
 
         new_contract = database.Contract(
@@ -213,24 +176,158 @@ async def create_contract(
             base_price                  =   base_price,
             t1_bonus                    =   t1_incentive,
             t2_bonus                    =   t2_incentive,
-            base_lock                   =   None,
-            t1_lock                     =   None,
-            t2_lock                     =   None,
-            collateral_lock             =   None,
-            base_key                    =   None,
-            t1_key                      =   None,
-            t2_key                      =   None,
-            collateral_key              =   None,
             sensor_id                   =   None,
             contract_title              =   title,
             contract_description        =   desc,
         )
         session.add(new_contract)
+        await session.flush()
+        await events.record(session, [events.event(
+            new_contract.contract_id, events.CREATED, new_contract.contract_status, user, public=True
+        )])
         await session.commit()
         await session.refresh(new_contract)
     return {"contract_id": new_contract.contract_id, "title": new_contract.contract_title}
 
-@router.get("/{contract_id}", tags=["Contracts", "Proposer", "Courier"])
+@router.post("/bulk/create-contracts", tags=["Contracts", "Proposer"])
+async def bulk_create_contracts(
+    request: Request,
+    response: Response,
+    _auth: None=Depends(auth.check_and_renew_access_token)
+    ):
+    '''
+    Creates many contracts at once.
+    Body is a JSON list or a CSV file (Content-Type: text/csv) with the same fields as /create-contract.
+    Either every row is created or, if any row is invalid, none are.
+    '''
+    user = auth.get_current_user(request)['sub']
+    contracts = await bulk.parse_rows(request, bulk.ContractIn)
+    if not contracts:
+        return {"created": 0, "results": []}
+
+    async with database.AsyncSessionLocalFactory() as session:
+        created = (await session.execute(bulk.insert_contracts(user, contracts))).all()
+        await events.record(session, [
+            events.event(contract_id, events.CREATED, database.ContractStatus.OPEN.value, user, public=True)
+            for contract_id, _ in created
+        ])
+        await session.commit()
+
+    # multi-row INSERT ... RETURNING gives rows back in the order of VALUES
+    return {
+        "created": len(created),
+        "results": [
+            {"row": idx, "contract_id": contract_id, "title": title}
+            for idx, (contract_id, title) in enumerate(created)
+        ]
+    }
+
+@router.post("/bulk/update-contracts", tags=["Contracts", "Proposer"])
+async def bulk_update_contracts(
+    request: Request,
+    response: Response,
+    _auth: None=Depends(auth.check_and_renew_access_token)
+    ):
+    '''
+    Updates price, collateral, incentives, timeout, title or description of many contracts at once.
+    Body is a JSON list or a CSV file (Content-Type: text/csv) with contract_id plus the
+    /update-contract fields to change. Only your OPEN contracts are updated.
+    '''
+    user = auth.get_current_user(request)['sub']
+    changes = await bulk.parse_rows(request, bulk.ContractUpdateIn)
+    if not changes:
+        return {"updated": 0, "results": []}
+
+    # a contract can only be joined against one row of changes
+    seen = set()
+    duplicates = []
+    for idx, change in enumerate(changes):
+        if change.contract_id in seen:
+            duplicates.append({"row": idx, "errors": ["Contract appears more than once"]})
+        seen.add(change.contract_id)
+    if duplicates:
+        response.status_code = 422
+        return {"detail": duplicates}
+
+    async with database.AsyncSessionLocalFactory() as session:
+        updated = set((await session.execute(bulk.update_contracts(user, changes))).scalars().all())
+        await events.record(session, [
+            events.event(contract_id, events.UPDATED, database.ContractStatus.OPEN.value, user, public=True)
+            for contract_id in sorted(updated)
+        ])
+        await session.commit()
+
+    return {
+        "updated": len(updated),
+        "results": [
+            {
+                "row": idx,
+                "contract_id": change.contract_id,
+                "status": "updated" if change.contract_id in updated else "not found or not open"
+            } for idx, change in enumerate(changes)
+        ]
+    }
+
+@router.get("/export", tags=["Contracts", "Proposer", "Courier"])
+async def export_contracts(
+    request: Request,
+    response: Response,
+    format: Literal["csv", "ndjson", "parquet"] = "csv",
+    _auth: None=Depends(auth.check_and_renew_access_token)
+    ):
+    '''
+    Streams the full history of contracts the user proposed or delivered, with each escrow leg's sequence and state.
+    Format is csv, ndjson, or parquet (if the server has pyarrow installed).
+    '''
+    user = auth.get_current_user(request)['sub']
+    if format == "parquet" and not export.parquet_available():
+        response.status_code = 501
+        return {"detail": "Parquet export is not available on this server"}
+
+    return StreamingResponse(
+        export.export_stream(user, format),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="contracts.{format}"'}
+    )
+
+@router.get("/changes", tags=["Contracts", "Proposer", "Courier"])
+async def get_contract_changes(
+    request: Request,
+    response: Response,
+    since: Optional[str] = None,
+    _auth: None=Depends(auth.check_and_renew_access_token)
+    ):
+    '''
+    Returns what changed since a cursor: events for the user's own contracts, and for open contracts.
+    Start without a cursor, then pass the returned cursor on the next call.
+    If has_more is set, call again straight away for the next page.
+    '''
+    user = auth.get_current_user(request)['sub']
+    try:
+        cursor = events.parse_cursor(since)
+    except ValueError:
+        response.status_code = 400
+        return {"detail": "Invalid cursor"}
+
+    async with database.AsyncSessionLocalFactory() as session:
+        changes = await session.execute(events.changes_query(user, cursor, events.CHANGES_PAGE_SIZE))
+        changes = changes.all()
+
+    if changes:
+        cursor = (changes[-1].xact_id, changes[-1].event_id)
+    return {
+        "changes": [
+            {
+                "contract_id": change.contract_id,
+                "event": change.event_type,
+                "contract_status": change.contract_status,
+            } for change in changes
+        ],
+        "cursor": events.format_cursor(*cursor),
+        "has_more": len(changes) == events.CHANGES_PAGE_SIZE,
+    }
+
+@router.get("/{contract_id}", tags=["Contracts", "Proposer", "Courier"], response_model=ContractOut)
 async def get_contract(
     contract_id: int,
     request: Request,
@@ -242,10 +339,9 @@ async def get_contract(
     Contract has to be open, or the user has to be the proposer / courier.
     '''
     user = auth.get_current_user(request)['sub']
-    print(f"User: {user}")
     async with database.AsyncSessionLocalFactory() as session:
         contract = await session.execute(
-            select(database.Contract).where(
+            select_contracts().where(
                 (database.Contract.contract_id == contract_id) &
                 (
                     (
@@ -257,27 +353,24 @@ async def get_contract(
                 )
             )
         )
-        contract:database.Contract = contract.scalars().first()
+        contract = contract.first()
         if not contract:
-            response.status_code = 404
-            return {"detail": "Contract not found"}
-
-        retstruct = {
-            "contract_id":  contract.contract_id,
-            "proposer_id":  contract.proposer_id,
-            "courier_id":   contract.courier_id,
-            "contract_award_time": contract.contract_award_time,
-            "contract_completion_time": contract.contract_completion_time,
-            "contract_timeout": contract.contract_timeout,
-            "contractStatus": contract.contract_status,
-            "required_collateral": contract.required_collateral,
-            "base_price": contract.base_price,
-            "t1_bonus": contract.t1_bonus,
-            "t2_bonus": contract.t2_bonus,
-            "title": contract.contract_title,
-            "description": contract.contract_description,
-        }
-        return retstruct
+            # settled contracts move to the archive after a while, they are never open
+            archive = database.contracts_archive
+            contract = await session.execute(
+                select_contracts(contracts=archive).where(
+                    (archive.c.contract_id == contract_id) &
+                    (
+                        (archive.c.proposer_id == user) |
+                        (archive.c.courier_id == user)
+                    )
+                )
+            )
+            contract = contract.first()
+        if not contract:
+            raise HTTPException(status_code=404, detail="Contract not found")
+
+    return contract_response(contract, response)
 
 @router.post("/{contract_id}/update-contract", tags=["Contracts", "Proposer"])
 async def update_contract(
@@ -303,7 +396,7 @@ async def update_contract(
         new_timeout,
         "%Y-%m-%dT%H:%M:%S"
     )
-    dt = dt.replace(tzinfo=pytz.utc) 
+    dt = dt.replace(tzinfo=timezone.utc) 
     async with database.AsyncSessionLocalFactory() as session:
         contract = await session.execute(
             select(database.Contract).where(
@@ -329,6 +422,9 @@ async def update_contract(
 
         # commit entry back to database
         session.add(contract)
+        await events.record(session, [events.event(
+            contract.contract_id, events.UPDATED, contract.contract_status, user, public=True
+        )])
         await session.commit()
 
     return {"detail": "Contract updated successfully"}
@@ -360,6 +456,9 @@ async def delete_contract(
 
         # delete the contract
         await session.delete(contract)
+        await events.record(session, [events.event(
+            contract.contract_id, events.DELETED, events.DELETED_STATUS, user, public=True
+        )])
         await session.commit()
     return {"detail": "Contract deleted successfully"}
 
@@ -369,6 +468,7 @@ async def accept_contract(
     sensorid: str,
     request: Request,
     response: Response,
+    idempotency_key: Optional[str] = Header(None),
     _auth: None=Depends(auth.check_and_renew_access_token)
     ):
     '''
@@ -376,53 +476,85 @@ async def accept_contract(
     Requires Sensor to be specified.
     Only works if contract status is open.
     Locks in actual contract with the XRP network.
+    Retries with the same Idempotency-Key header get the original response.
     '''
 
     user = auth.get_current_user(request)['sub']
-    async with database.AsyncSessionLocalFactory() as session:
-        contract = await session.execute(
-            select(database.Contract).where(
-                database.Contract.contract_id == contract_id,
-                database.Contract.contract_status == database.ContractStatus.OPEN.value
-            )
-        )
-        contract: database.Contract = contract.scalars().first()
+    return await idempotency.run_once(
+        idempotency_key, user, request, response,
+        lambda: _accept_contract(contract_id, sensorid, user, response)
+    )
 
+async def _accept_contract(contract_id: int, sensorid: str, user: str, response: Response):
+    async with database.AsyncSessionLocalFactory() as session:
+        # lock the sensor so two accepts can't both pass the in use check,
+        # a concurrent accept holding the lock loses straight away
         sensor = await session.execute(
             select(database.Sensor).where(
                 database.Sensor.sensor_id == sensorid,
                 database.Sensor.owner_id == user
-            )
+            ).with_for_update(skip_locked=True)
         )
         sensor: database.Sensor = sensor.scalars().first()
 
+        if not sensor:
+            sensor_exists = await session.execute(
+                select(database.Sensor.sensor_id).where(
+                    database.Sensor.sensor_id == sensorid,
+                    database.Sensor.owner_id == user
+                )
+            )
+            if sensor_exists.scalars().first():
+                response.status_code = 409
+                return {"detail": "Sensor is being assigned to another contract."}
+            response.status_code = 404
+            return {"detail": "Sensor not found or not owned by user."}
+
         sensor_in_use = await session.execute(
-            select(database.Contract).where(
+            select(database.Contract.contract_id).where(
                 database.Contract.sensor_id == sensorid,
-                database.Contract.contract_status != database.ContractStatus.COMPLETED.value
+                database.Contract.contract_status.in_([
+                    database.ContractStatus.FULFILLMENT.value,
+                    database.ContractStatus.SETTLING.value,
+                ])
             )
         )
-        sensor_in_use: database.Contract = sensor_in_use.scalars().first()
-        
-        
-        if not contract:
-            response.status_code = 404
-            return {"detail": "Contract not found or not open."}
-        
-        if not sensor:
-            response.status_code = 404
-            return {"detail": "Sensor not found or not owned by user."}
-        
-        if sensor_in_use:
-            response.status_code = 404
+        if sensor_in_use.scalars().first():
+            response.status_code = 409
             return {"detail": "Sensor currently in use for other contract."}
 
+        # claim the contract atomically before any ledger work,
+        # only one courier can move it out of OPEN
+        contract = await session.execute(
+            update(database.Contract)
+            .where(
+                database.Contract.contract_id == contract_id,
+                database.Contract.contract_status == database.ContractStatus.OPEN.value,
+                database.Contract.contract_timeout > datetime.now(timezone.utc)
+            )
+            .values(
+                courier_id=user,
+                sensor_id=sensor.sensor_id,
+                contract_status=database.ContractStatus.FULFILLMENT.value,
+                contract_award_time=datetime.now(timezone.utc)
+            )
+            .returning(database.Contract)
+            .execution_options(synchronize_session=False)
+        )
+        contract: database.Contract = contract.scalars().first()
 
-        # modify the contract to set the courier, sensor, and status
-        contract.courier_id = user
-        contract.sensor_id = sensor.sensor_id
-        contract.contract_status = database.ContractStatus.FULFILLMENT.value
-        contract.contract_award_time = datetime.now(timezone.utc)
+        if not contract:
+            claimed = await session.execute(
+                select(database.Contract.contract_id).where(
+                    database.Contract.contract_id == contract_id,
+                    database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value
+                )
+            )
+            if claimed.scalars().first():
+                response.status_code = 409
+                return {"detail": "Contract was accepted by another courier."}
+            response.status_code = 404
+            return {"detail": "Contract not found or not open."}
 
         # get xrp details for proposer and courier
         proposer_details = await session.execute(
@@ -439,13 +571,24 @@ async def accept_contract(
         )
         courier_details: database.User = courier_details.scalars().first()
 
-        print(f"courier wallet num:{courier_details.wallet_number}")
-        print(f"courier wallet addr:{courier_details.wallet_address}")
-        print(f"proposer wallet num:{proposer_details.wallet_number}")
-        print(f"proposer wallet addr:{proposer_details.wallet_address}")
+        # the contract leaves the open list
+        await events.record(session, [events.event(
+            contract.contract_id, events.ACCEPTED, contract.contract_status,
+            contract.proposer_id, contract.courier_id, public=True
+        )])
 
+        try:
+            await session.commit()
+        except IntegrityError:
+            # another contract claimed the sensor first (contracts_active_sensor_idx)
+            await session.rollback()
+            response.status_code = 409
+            return {"detail": "Sensor currently in use for other contract."}
 
-        [sequences, conditions, fulfillments] = await xrp.create_escrow(
+    # no session is held while the escrows are created on the ledger
+    payment_escrows = None
+    try:
+        payment_escrows = await xrp.create_escrow(
             proposer_details.wallet_number, 
             courier_details.wallet_address, 
             [contract.base_price, contract.t1_bonus, contract.t2_bonus], 
@@ -453,47 +596,112 @@ async def accept_contract(
             contract.contract_timeout
         )
 
-        [collateral_txid, collateral_lock, collateral_key] = await xrp.create_escrow(
+        collateral_escrow = await xrp.create_escrow(
             courier_details.wallet_number, 
             proposer_details.wallet_address, 
             [contract.required_collateral], 
             True,
             contract.contract_timeout
         )
+    except Exception as e:
+        created = e.created if isinstance(e, xrp.EscrowCreateFailed) else None
+        # escrows that made it onto the ledger before the failure
+        if payment_escrows is None:
+            stray_legs = settlement.new_legs(contract.contract_id, created, None)
+        else:
+            stray_legs = settlement.new_legs(contract.contract_id, payment_escrows, created)
+        cause = e.cause if isinstance(e, xrp.EscrowCreateFailed) else e
+
+        async with database.AsyncSessionLocalFactory() as session:
+            if stray_legs:
+                # the contract can't be accepted again while its escrows are on the ledger,
+                # so it is closed and the escrows go back once they expire
+                for leg in stray_legs:
+                    leg["state"] = database.EscrowState.FORFEITED.value
+                await session.execute(insert(database.EscrowLeg).values(stray_legs))
+                closed_status = database.ContractStatus.FAILED.value
+                closing = update(database.Contract).values(contract_status=closed_status)
+                closed_event = events.FAILED
+            else:
+                # give the contract back so another courier can accept it
+                closed_status = database.ContractStatus.OPEN.value
+                closing = update(database.Contract).values(
+                    courier_id=None,
+                    sensor_id=None,
+                    contract_status=closed_status,
+                    contract_award_time=None
+                )
+                closed_event = events.REOPENED
+            closed = await session.execute(
+                closing
+                .where(
+                    database.Contract.contract_id == contract.contract_id,
+                    database.Contract.courier_id == user,
+                    database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value
+                )
+                .returning(database.Contract.contract_id)
+                .execution_options(synchronize_session=False)
+            )
+            if closed.scalars().first():
+                await events.record(session, [events.event(
+                    contract.contract_id, closed_event, closed_status,
+                    contract.proposer_id, user, public=not stray_legs
+                )])
+            await session.commit()
 
-        # set the locks and keys in the database
-        contract.base_txn_id        = str(sequences[0])
-        contract.t1_txn_id          = str(sequences[1])
-        contract.t2_txn_id          = str(sequences[2])
-        contract.collateral_txn_id  = str(collateral_txid[0])
-        contract.base_lock          = conditions[0]
-        contract.t1_lock            = conditions[1]
-        contract.t2_lock            = conditions[2]
-        contract.collateral_lock    = collateral_lock[0]
-        contract.base_key           = fulfillments[0]
-        contract.t1_key             = fulfillments[1]
-        contract.t2_key             = fulfillments[2]
-        contract.collateral_key     = collateral_key[0]
+        if stray_legs:
+            detail = (
+                f"Could not lock funds on the ledger: {str(cause)}. The contract was closed, "
+                f"the {len(stray_legs)} escrows already created are returned once they expire"
+            )
+        elif isinstance(cause, xrp.LedgerUnavailable):
+            detail = f"Ledger is unavailable, please retry: {str(cause)}"
+        else:
+            detail = f"Could not lock funds on the ledger: {str(cause)}"
+        response.status_code = 503 if isinstance(cause, xrp.LedgerUnavailable) else 502
+        return {"detail": detail}
 
-        # commit entry back to database
-        session.add(contract)
+    # store the escrow legs
+    legs = settlement.new_legs(contract.contract_id, payment_escrows, collateral_escrow)
+    async with database.AsyncSessionLocalFactory() as session:
+        # the sweeper may have failed the contract while the escrows were being created,
+        # the row lock keeps it from doing so until the legs are in
+        still_held = await session.execute(
+            select(database.Contract.contract_id)
+            .where(
+                database.Contract.contract_id == contract.contract_id,
+                database.Contract.courier_id == user,
+                database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value
+            )
+            .with_for_update()
+        )
+        still_held = still_held.scalars().first()
+        if not still_held:
+            # queue the escrows for the sweeper to cancel
+            for leg in legs:
+                leg["state"] = database.EscrowState.CANCELLING.value
+        await session.execute(insert(database.EscrowLeg).values(legs))
         await session.commit()
-        await session.refresh(contract)
 
-        # return the contract id and the updated fields
-        return ({
-            "contract_id": contract.contract_id,
-            "courier_id": contract.courier_id,
-            "sensor_id": contract.sensor_id,
-            "contract_status": contract.contract_status,
-            "contract_award_time": contract.contract_award_time,
-        })
+    if not still_held:
+        response.status_code = 409
+        return {"detail": "Contract was closed while its funds were being locked, the escrows are being returned"}
+
+    # return the contract id and the updated fields
+    return ({
+        "contract_id": contract.contract_id,
+        "courier_id": contract.courier_id,
+        "sensor_id": contract.sensor_id,
+        "contract_status": contract.contract_status,
+        "contract_award_time": contract.contract_award_time,
+    })
 
 @router.post("/{contract_id}/complete-contract", tags=["Contracts", "Courier", "Proposer"])
 async def complete_contract(
     contract_id: int,
     request: Request,
     response: Response,
+    idempotency_key: Optional[str] = Header(None),
     _auth: None=Depends(auth.check_and_renew_access_token)
     ):
     '''
@@ -501,13 +709,24 @@ async def complete_contract(
     Only works if contract status is FULFILLMENT.
     Finishes the contract, and releases the fund locks.
     Both the proposer and the courier have to agree to the completion. 
+    Retries with the same Idempotency-Key header get the original response.
     '''
     user = auth.get_current_user(request)['sub']
+    return await idempotency.run_once(
+        idempotency_key, user, request, response,
+        lambda: _complete_contract(contract_id, user, response)
+    )
+
+async def _complete_contract(contract_id: int, user: str, response: Response):
     async with database.AsyncSessionLocalFactory() as session:
         contract = await session.execute(
             select(database.Contract).where(
                 (database.Contract.contract_id == contract_id) &
-                (database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value)
+                (database.Contract.contract_status.in_([
+                    database.ContractStatus.FULFILLMENT.value,
+                    # a confirm whose settlement partially failed, being retried
+                    database.ContractStatus.SETTLING.value,
+                ]))
             )
         )
         contract: database.Contract = contract.scalars().first()
@@ -539,6 +758,10 @@ async def complete_contract(
             # Courier is the first user to mark the contract as completed
             contract.contract_completion_time = datetime.now(timezone.utc)
             session.add(contract)
+            await events.record(session, [events.event(
+                contract.contract_id, events.DELIVERED, contract.contract_status,
+                contract.proposer_id, contract.courier_id
+            )])
             await session.commit()
             return {'detail': "Courier has marked contract as completed, waiting for proposer to confirm"}
 
@@ -554,8 +777,22 @@ async def complete_contract(
 
         # if the user is the proposer and the courier has already marked the contract as completed
         # proposer is confirming the completion
-        contract.contract_confirm_completion = datetime.now(timezone.utc)
-        contract.contract_status = database.ContractStatus.COMPLETED.value
+
+        # claim the contract before anything else, so the sweeper can't fail it
+        # and the sensor data can't change while it is settled
+        if contract.contract_status == database.ContractStatus.FULFILLMENT.value:
+            claimed = await session.execute(
+                update(database.Contract)
+                .where(
+                    database.Contract.contract_id == contract.contract_id,
+                    database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value,
+                )
+                .values(contract_status=database.ContractStatus.SETTLING.value)
+                .returning(database.Contract.contract_id)
+            )
+            if not claimed.first():
+                response.status_code = 409
+                return {"detail": "Contract is no longer in fulfillment"}
 
         # get xrp details for proposer and courier
         proposer_details = await session.execute(
@@ -572,74 +809,96 @@ async def complete_contract(
         )
         courier_details: database.User = courier_details.scalars().first()
 
+        legs = (await settlement.load_legs(session, [contract.contract_id])).get(contract.contract_id)
+        if not legs:
+            response.status_code = 409
+            return {"detail": "Contract escrows are not locked on the ledger yet"}
+
+        # work out the payout from the sensor data once, and store it before touching the ledger
+        seen = settlement.snapshot(legs.values())
+        settlement.apply_plan(legs, settlement.plan_payout(sensor_data))
+        await settlement.save_states(session, legs.values(), seen)
+        # lease the pending legs, a concurrent confirm skips them instead of submitting them again
+        claimed, lease = await settlement.claim_pending(session, legs.values())
+        await session.commit()
+    busy = [leg for leg in settlement.pending_legs(legs) if legs[leg] not in claimed]
+
+    # no session is held while the escrows are finished / cancelled on the ledger
+    seen = settlement.snapshot(legs.values())
+    errors = await settlement.submit_pending_legs(
+        {escrow_leg.leg: escrow_leg for escrow_leg in claimed},
+        proposer_details.wallet_number,
+        courier_details.wallet_number
+    )
 
-        # TODO: Use the sensor data here to finish the contract / return collat. conditionally
-        #1,2,3 as last arg mean base, t1 incentive, t2 incentive respectively
-        
-        # 0 means return collateral to the courier, 1 means give the courier's collateral to the proposer
-        collateral_status = 0
-        if(sensor_data):
-            # if we have sensor data
-            if (sensor_data.drop_alerts <= 2):
-                # great performance, 
-                await xrp.finish_contract([contract.base_txn_id, contract.t1_txn_id, contract.t2_txn_id],
-                                [contract.base_lock, contract.t1_lock, contract.t2_lock],
-                                [contract.base_key, contract.t1_key, contract.t2_key], 
-                                proposer_details.wallet_number, 
-                                3)
-            elif (2 < sensor_data.drop_alerts <= 4):
-                # lose tier 2, only get tier 1 and base
-                await xrp.finish_contract([contract.base_txn_id, contract.t1_txn_id, contract.t2_txn_id],
-                                [contract.base_lock, contract.t1_lock, contract.t2_lock],
-                                [contract.base_key, contract.t1_key, contract.t2_key], 
-                                proposer_details.wallet_number, 
-                                2)
-            elif (4 < sensor_data.drop_alerts <= 6):
-                # only get base
-                await xrp.finish_contract([contract.base_txn_id, contract.t1_txn_id, contract.t2_txn_id],
-                                [contract.base_lock, contract.t1_lock, contract.t2_lock],
-                                [contract.base_key, contract.t1_key, contract.t2_key], 
-                                proposer_details.wallet_number, 
-                                1)
-            elif (6 < sensor_data.drop_alerts):
-                # lose collateral if too many drops
-                collateral_status = 1
-        else:
-            # default to full payout
-            await xrp.finish_contract([contract.base_txn_id, contract.t1_txn_id, contract.t2_txn_id],
-                                [contract.base_lock, contract.t1_lock, contract.t2_lock],
-                                [contract.base_key, contract.t1_key, contract.t2_key], 
-                                proposer_details.wallet_number, 
-                                3)
-
-
-        if(collateral_status):
-            await xrp.finish_contract([contract.collateral_txn_id],
-                            [contract.collateral_lock],
-                            [contract.collateral_key], 
-                            courier_details.wallet_number, 
-                            1)
-        else:
-            await xrp.delete_escrow(
-                courier_details.wallet_number,
-                int(contract.collateral_txn_id)
+    async with database.AsyncSessionLocalFactory() as session:
+        # keep the legs that went through, whatever happened to the others
+        await settlement.save_states(session, legs.values(), seen)
+        await settlement.release_claims(session, claimed, lease)
+        completed = None
+        if not errors and not busy:
+            contract.contract_confirm_completion = datetime.now(timezone.utc)
+            contract.contract_status = database.ContractStatus.COMPLETED.value
+
+            # only the request that sees every leg settled completes the contract
+            pending_leg = exists().where(
+                database.EscrowLeg.contract_id == database.Contract.contract_id,
+                database.EscrowLeg.state.in_(list(settlement.PENDING_STATES)),
+            )
+            completed = await session.execute(
+                update(database.Contract)
+                .where(
+                    database.Contract.contract_id == contract.contract_id,
+                    database.Contract.contract_status == database.ContractStatus.SETTLING.value,
+                    ~pending_leg,
+                )
+                .values(
+                    contract_confirm_completion=contract.contract_confirm_completion,
+                    contract_status=contract.contract_status
+                )
+                .returning(database.Contract.contract_id)
+                .execution_options(synchronize_session=False)
+            )
+            completed = completed.first()
+
+        if completed:
+            # fold this delivery into the courier's running totals, before the sensor data is wiped
+            await analytics.record_completion(session, contract, sensor_data)
+            tracking.store.evict(contract.contract_id)
+            await events.record(session, [events.event(
+                contract.contract_id, events.COMPLETED, contract.contract_status,
+                contract.proposer_id, contract.courier_id
+            )])
+
+            # Wipes the sensor data entry
+            await session.execute(
+                update(database.SensorData)
+                .where(database.SensorData.sensor_id == contract.sensor_id)
+                .values(
+                    drop_alerts=0,
+                    overtemp_alerts=0,
+                    water_events=0,
+                    longitude=0,
+                    latitude=0
+                )
+                .execution_options(synchronize_session=False)
             )
-
-        # Wipes the sensor data entry
-        if(sensor_data):
-            sensor_data.drop_alerts = 0
-            sensor_data.overtemp_alerts = 0
-            sensor_data.water_events = 0
-            sensor_data.longitude = 0
-            sensor_data.latitude = 0
-            session.add(sensor_data)
-
-
         # commit entry back to database
-        session.add(contract)
         await session.commit()
-        await session.refresh(contract)
-        
+
+    if errors:
+        # the proposer can retry the rest
+        response.status_code = 502
+        return {
+            "detail": "Some escrows could not be settled, please retry",
+            "escrows": settlement.leg_states(legs),
+            "errors": errors,
+        }
+
+    if not completed:
+        # a concurrent confirm settled some of the legs, or still is
+        response.status_code = 409
+        return {"detail": "Contract is being settled by another request"}
 
     # return the contract id and the updated fields
     return ({
@@ -649,6 +908,7 @@ async def complete_contract(
         "contract_status": contract.contract_status,
         "contract_completion_time": contract.contract_completion_time,
         "contract_confirm_completion": contract.contract_confirm_completion,
+        "escrows": settlement.leg_states(legs),
     })
 
 
@@ -0,0 +1,103 @@
+'''
+Contract change log, for clients that sync incrementally instead of refetching lists.
+
+Every state transition appends a row to contract_events in the same transaction,
+so the log never disagrees with the contracts table. Clients poll
+/contracts/changes with the cursor from their last page and get back only the
+events they may see: their own contracts, plus any contract that was open.
+
+Cursors are "<xact_id>-<event_id>". Events are only handed out once every
+transaction that could still add an earlier one has finished (the xmin of the
+current snapshot), so a slow transaction committing late can never slip an event
+in behind a cursor a client already holds.
+'''
+import os
+from sqlalchemy import insert, union, tuple_, literal, literal_column, BigInteger
+from sqlalchemy.future import select
+
+from database import database
+
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "500"))
+
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+ACCEPTED = "accepted"
+REOPENED = "reopened"
+DELIVERED = "delivered"
+COMPLETED = "completed"
+EXPIRED = "expired"
+FAILED = "failed"
+# moved to the archive, see contracts/retention.py
+ARCHIVED = "archived"
+
+# contract_status recorded for deleted contracts
+DELETED_STATUS = "DELETED"
+
+EVENT_COLUMNS = (
+    database.ContractEvent.xact_id,
+    database.ContractEvent.event_id,
+    database.ContractEvent.contract_id,
+    database.ContractEvent.event_type,
+    database.ContractEvent.contract_status,
+)
+
+# every transaction below this has committed or rolled back
+_SNAPSHOT_XMIN = literal_column("pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+
+
+def event(contract_id: int, event_type: str, contract_status: str, proposer_id: str,
+          courier_id: str = None, public: bool = False) -> dict:
+    return {
+        "contract_id": contract_id,
+        "event_type": event_type,
+        "contract_status": contract_status,
+        "proposer_id": proposer_id,
+        "courier_id": courier_id,
+        "public": public,
+    }
+
+
+async def record(session, events: list):
+    '''
+    Appends events in the session's transaction, all in one statement.
+    '''
+    if events:
+        await session.execute(insert(database.ContractEvent).values(events))
+
+
+def parse_cursor(cursor: str):
+    '''
+    Returns (xact_id, event_id) for a cursor, or raises ValueError.
+    '''
+    if not cursor:
+        return 0, 0
+    xact_id, event_id = cursor.split("-")
+    return int(xact_id), int(event_id)
+
+
+def format_cursor(xact_id: int, event_id: int) -> str:
+    return f"{xact_id}-{event_id}"
+
+
+def changes_query(user: str, since: tuple, limit: int):
+    '''
+    Events after the cursor that the user may see, oldest first.
+    One branch per index, so each one is an index only scan.
+    '''
+    after = tuple_(database.ContractEvent.xact_id, database.ContractEvent.event_id) > tuple_(
+        *(literal(value, BigInteger) for value in since)
+    )
+    settled = database.ContractEvent.xact_id < _SNAPSHOT_XMIN
+    order = (database.ContractEvent.xact_id, database.ContractEvent.event_id)
+
+    branches = [
+        select(*EVENT_COLUMNS).where(visible, after, settled).order_by(*order).limit(limit)
+        for visible in (
+            database.ContractEvent.proposer_id == user,
+            database.ContractEvent.courier_id == user,
+            database.ContractEvent.public,
+        )
+    ]
+    changes = union(*branches).subquery()
+    return select(changes).order_by(changes.c.xact_id, changes.c.event_id).limit(limit)
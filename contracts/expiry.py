@@ -0,0 +1,220 @@
+'''
+Background sweeper that acts on contract_timeout.
+
+Each pass expires OPEN contracts past their deadline, fails FULFILLMENT contracts
+past their deadline, and queues the escrows that can be returned for cancellation
+(all locked legs of failed contracts, and the forfeited bonus legs of completed
+contracts). The queued cancellations are then submitted to the ledger in batches.
+Only one worker runs the updates at a time, through a postgres advisory lock.
+The lock is released before the ledger is called, the legs being cancelled are
+leased instead (see contracts/settlement.py).
+'''
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, or_
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+from database import database
+from contracts import settlement
+from contracts import analytics
+from contracts import events
+from sensor import tracking
+import xrpledger.smart_contracts as xrp
+
+EXPIRY_SWEEP_INTERVAL_SECONDS = int(os.getenv("EXPIRY_SWEEP_INTERVAL_SECONDS", "30"))
+# escrows can only be cancelled once a ledger closes after their CancelAfter time
+EXPIRY_GRACE_SECONDS = int(os.getenv("EXPIRY_GRACE_SECONDS", "30"))
+# escrows cancelled per pass
+EXPIRY_CANCEL_BATCH_SIZE = int(os.getenv("EXPIRY_CANCEL_BATCH_SIZE", "200"))
+
+EXPIRY_LOCK_NAME = "contracts.expiry"
+
+SETTLED_LEG_STATES = [database.EscrowState.FINISHED.value, database.EscrowState.CANCELLED.value]
+
+
+async def expire_due_contracts(now: datetime, cutoff: datetime) -> dict:
+    '''
+    Marks every due contract in bulk. OPEN contracts expire as soon as they are due,
+    anything holding escrows waits until the cutoff so the ledger accepts the cancellations.
+    Returns the ids of the contracts that changed, by new status.
+    '''
+    async with database.AsyncSessionLocalFactory() as session:
+        expired = await session.execute(
+            update(database.Contract)
+            .where(
+                database.Contract.contract_status == database.ContractStatus.OPEN.value,
+                database.Contract.contract_timeout <= now,
+            )
+            .values(contract_status=database.ContractStatus.EXPIRED.value)
+            .returning(database.Contract.contract_id, database.Contract.proposer_id)
+            .execution_options(synchronize_session=False)
+        )
+        expired = expired.all()
+        await events.record(session, [
+            events.event(contract_id, events.EXPIRED, database.ContractStatus.EXPIRED.value, proposer_id, public=True)
+            for contract_id, proposer_id in expired
+        ])
+        expired = [contract_id for contract_id, _ in expired]
+
+        failed = await session.execute(
+            update(database.Contract)
+            .where(
+                database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value,
+                database.Contract.contract_timeout <= cutoff,
+            )
+            .values(contract_status=database.ContractStatus.FAILED.value)
+            .returning(database.Contract.contract_id, database.Contract.proposer_id, database.Contract.courier_id)
+            .execution_options(synchronize_session=False)
+        )
+        failed = failed.all()
+        await analytics.record_failures(session, [courier_id for _, _, courier_id in failed])
+        await events.record(session, [
+            events.event(contract_id, events.FAILED, database.ContractStatus.FAILED.value, proposer_id, courier_id)
+            for contract_id, proposer_id, courier_id in failed
+        ])
+        failed = [contract_id for contract_id, _, _ in failed]
+        for contract_id in failed:
+            tracking.store.evict(contract_id)
+
+        # failed contracts give every leg that has not gone through back to its owner
+        if failed:
+            await session.execute(
+                update(database.EscrowLeg)
+                .where(
+                    database.EscrowLeg.contract_id.in_(failed),
+                    database.EscrowLeg.state.not_in(SETTLED_LEG_STATES),
+                )
+                .values(state=database.EscrowState.CANCELLING.value)
+                .execution_options(synchronize_session=False)
+            )
+
+        forfeited = await session.execute(
+            update(database.EscrowLeg)
+            .where(
+                database.EscrowLeg.contract_id == database.Contract.contract_id,
+                database.EscrowLeg.state == database.EscrowState.FORFEITED.value,
+                database.Contract.contract_timeout <= cutoff,
+            )
+            .values(state=database.EscrowState.CANCELLING.value)
+            .returning(database.EscrowLeg.contract_id)
+            .execution_options(synchronize_session=False)
+        )
+        forfeited = sorted(set(forfeited.scalars().all()))
+
+        await session.commit()
+
+    return {
+        database.ContractStatus.EXPIRED.value: expired,
+        database.ContractStatus.FAILED.value: failed,
+        "forfeited": forfeited,
+    }
+
+
+async def cancel_queued_escrows() -> int:
+    '''
+    Submits one batch of queued escrow cancellations to the ledger, across as
+    many contracts as the batch size allows.
+    Failed cancellations stay queued for the next pass.
+    Returns the number of escrows cancelled.
+    '''
+    proposer = aliased(database.User)
+    courier = aliased(database.User)
+
+    async with database.AsyncSessionLocalFactory() as session:
+        queued = await session.execute(
+            select(database.EscrowLeg, proposer.wallet_number, courier.wallet_number)
+            .join(database.Contract, database.Contract.contract_id == database.EscrowLeg.contract_id)
+            .join(proposer, proposer.user_id == database.Contract.proposer_id)
+            .join(courier, courier.user_id == database.Contract.courier_id)
+            .where(
+                database.EscrowLeg.state == database.EscrowState.CANCELLING.value,
+                database.Contract.contract_status.in_([
+                    database.ContractStatus.COMPLETED.value,
+                    database.ContractStatus.FAILED.value,
+                ]),
+                # skip legs another pass is still submitting
+                or_(
+                    database.EscrowLeg.claimed_until.is_(None),
+                    database.EscrowLeg.claimed_until < datetime.now(timezone.utc),
+                ),
+            )
+            .order_by(database.EscrowLeg.contract_id, database.EscrowLeg.leg)
+            .limit(EXPIRY_CANCEL_BATCH_SIZE)
+        )
+        queued = queued.all()
+        # the new states are only written by save_states, guarded on what was read here
+        session.expunge_all()
+        claimed, lease = await settlement.claim_pending(session, [escrow_leg for escrow_leg, _, _ in queued])
+        await session.commit()
+    queued = [(escrow_leg, proposer_seed, courier_seed) for escrow_leg, proposer_seed, courier_seed in queued
+              if escrow_leg in claimed]
+
+    # one ledger batch for every contract, sequences are assigned per account
+    legs = {}
+    seeds = {}
+    for escrow_leg, proposer_seed, courier_seed in queued:
+        legs.setdefault(escrow_leg.contract_id, {})[escrow_leg.leg] = escrow_leg
+        seeds[escrow_leg.contract_id] = (proposer_seed, courier_seed)
+    batch = [
+        (contract_id, settlement.build_actions(contract_legs, *seeds[contract_id]))
+        for contract_id, contract_legs in legs.items()
+    ]
+
+    submitted = [action for _, actions in batch for _, action in actions]
+    if not submitted:
+        return 0
+    seen = settlement.snapshot(escrow_leg for escrow_leg, _, _ in queued)
+    # no session is held while the cancellations are on the ledger
+    results = await xrp.submit_escrow_batch(submitted)
+
+    cancelled = 0
+    offset = 0
+    for contract_id, actions in batch:
+        errors = settlement.record_results(legs[contract_id], actions, results[offset:offset + len(actions)])
+        offset += len(actions)
+        cancelled += len(actions) - len(errors)
+        for leg, error in errors.items():
+            print(f"Could not cancel {leg} escrow of contract {contract_id}: {error}")
+
+    async with database.AsyncSessionLocalFactory() as session:
+        await settlement.save_states(session, claimed, seen)
+        await settlement.release_claims(session, claimed, lease)
+        await session.commit()
+
+    return cancelled
+
+
+async def sweep_expired_contracts():
+    '''
+    Runs one sweeper pass, unless another worker is already running one.
+    The lock only covers the database updates, it is released before the
+    cancellations go to the ledger. The legs being cancelled are leased instead,
+    so a pass that starts in the meantime skips them.
+    '''
+    async with database.advisory_lock(EXPIRY_LOCK_NAME) as acquired:
+        if not acquired:
+            return
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=EXPIRY_GRACE_SECONDS)
+        changed = await expire_due_contracts(now, cutoff)
+    cancelled = await cancel_queued_escrows()
+    if any(changed.values()) or cancelled:
+        print(
+            f"Expiry sweep: expired {len(changed[database.ContractStatus.EXPIRED.value])}, "
+            f"failed {len(changed[database.ContractStatus.FAILED.value])}, "
+            f"cancelled {cancelled} escrows"
+        )
+
+
+async def run_expiry_sweeper():
+    '''
+    Runs the expiry sweeper forever, every EXPIRY_SWEEP_INTERVAL_SECONDS.
+    '''
+    while True:
+        try:
+            await sweep_expired_contracts()
+        except Exception as e:
+            print(f"Expiry sweep failed: {e}")
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL_SECONDS)
@@ -0,0 +1,187 @@
+'''
+Streaming export of a user's contract and settlement history.
+
+Rows come off a server-side cursor in batches of EXPORT_BATCH_SIZE and are
+encoded and sent as each batch arrives, so memory stays flat however many
+contracts a user has and the first bytes go out before the query is done.
+CSV and NDJSON are always available, Parquet only if pyarrow is installed.
+'''
+import csv
+import io
+import os
+import orjson
+from sqlalchemy.future import select
+from sqlalchemy import TIMESTAMP, Integer, BigInteger, Float
+
+from database import database
+from contracts import settlement
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+CONTRACT_FIELDS = (
+    "contract_id",
+    "proposer_id",
+    "courier_id",
+    "contract_status",
+    "contract_award_time",
+    "contract_completion_time",
+    "contract_confirm_completion",
+    "contract_timeout",
+    "required_collateral",
+    "base_price",
+    "t1_bonus",
+    "t2_bonus",
+    "sensor_id",
+    "contract_title",
+    "contract_description",
+)
+
+
+def _history(contracts, legs):
+    '''
+    Contract columns plus each escrow leg's sequence and state, with one join per leg.
+    Conditions and fulfillments are never exported.
+    Works on the live tables and on their archive copies alike.
+    '''
+    leg_tables = {leg: legs.alias(f"{leg}_leg") for leg in settlement.ESCROW_LEGS}
+    query = select(
+        *(contracts.c[name] for name in CONTRACT_FIELDS),
+        *(table.c.sequence.label(f"{leg}_sequence") for leg, table in leg_tables.items()),
+        *(table.c.state.label(f"{leg}_state") for leg, table in leg_tables.items()),
+    ).select_from(contracts)
+    for leg, table in leg_tables.items():
+        query = query.outerjoin(
+            table, (table.c.contract_id == contracts.c.contract_id) & (table.c.leg == leg)
+        )
+    return query
+
+
+EXPORT_COLUMNS = tuple(_history(database.Contract.__table__, database.EscrowLeg.__table__).selected_columns)
+EXPORT_FIELDS = tuple(column.key for column in EXPORT_COLUMNS)
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+async def stream_rows(user: str):
+    '''
+    Yields batches of export rows for every contract the user proposed or delivered:
+    live contracts oldest first, then archived ones oldest first.
+    Each table is streamed on its own, so no sort has to run over both before the first row.
+    Opens its own session, since it runs after the endpoint has returned.
+    '''
+    async with database.AsyncSessionLocalFactory() as session:
+        # archived contracts are settled history too
+        for contracts, legs in (
+            (database.Contract.__table__, database.EscrowLeg.__table__),
+            (database.contracts_archive, database.escrow_legs_archive),
+        ):
+            query = (
+                _history(contracts, legs)
+                .where(
+                    (contracts.c.proposer_id == user) |
+                    (contracts.c.courier_id == user)
+                )
+                .order_by(contracts.c.contract_id)
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            result = await session.stream(query)
+            async for batch in result.partitions():
+                yield batch
+
+
+async def encode_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    async for batch in batches:
+        writer.writerows(
+            [value.isoformat() if hasattr(value, "isoformat") else value for value in row]
+            for row in batch
+        )
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+async def encode_ndjson(batches):
+    async for batch in batches:
+        yield b"".join(
+            orjson.dumps(dict(zip(EXPORT_FIELDS, row))) + b"\n" for row in batch
+        )
+
+
+class _Drain(io.RawIOBase):
+    '''
+    Write-only file that hands back whatever was written since the last drain,
+    while still reporting the full file position to the parquet writer.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def encode_parquet(batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_types = {
+        TIMESTAMP: pa.timestamp("us", tz="UTC"),
+        Integer: pa.int64(),
+        BigInteger: pa.int64(),
+        Float: pa.float64(),
+    }
+    schema = pa.schema([
+        (column.key, parquet_types.get(type(column.type), pa.string()))
+        for column in EXPORT_COLUMNS
+    ])
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema)
+    # one row group per batch
+    async for batch in batches:
+        writer.write_table(pa.Table.from_pylist(
+            [dict(zip(EXPORT_FIELDS, row)) for row in batch], schema=schema
+        ))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    "csv": encode_csv,
+    "ndjson": encode_ndjson,
+    "parquet": encode_parquet,
+}
+
+
+def export_stream(user: str, format: str):
+    return ENCODERS[format](stream_rows(user))
@@ -0,0 +1,219 @@
+'''
+Idempotency-Key support for the contract endpoints that talk to the ledger.
+
+The first request with a given key claims it in the idempotency_keys table and
+runs normally. Its response is stored, and any retry with the same key gets the
+stored response back without touching the contract row or the ledger.
+Retries that arrive while the first request is still running wait for it:
+in the same worker through an in-memory future, across workers by polling the key.
+Keys expire IDEMPOTENCY_TTL_SECONDS after their request finishes, and a background
+job prunes them from one worker at a time.
+'''
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from database import database
+
+# how long a retry waits for the original request before giving up
+IDEMPOTENCY_WAIT_SECONDS = int(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "60"))
+# an IN_PROGRESS key older than this belongs to a request that died, and can be taken over
+IDEMPOTENCY_STALE_SECONDS = int(os.getenv("IDEMPOTENCY_STALE_SECONDS", "300"))
+IDEMPOTENCY_POLL_SECONDS = 0.25
+# how long a stored response answers retries, and how often expired ones are pruned
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_PRUNE_INTERVAL_SECONDS = int(os.getenv("IDEMPOTENCY_PRUNE_INTERVAL_SECONDS", "3600"))
+
+IDEMPOTENCY_PRUNE_LOCK_NAME = "contracts.idempotency.prune"
+
+# (user, key) -> (fingerprint, future resolving to (status code, body)) for requests running in this worker
+_in_flight = {}
+
+
+def fingerprint_request(request: Request) -> str:
+    '''
+    Fingerprints the parts of the request that define what it does.
+    '''
+    return hashlib.sha256(
+        f"{request.method} {request.url.path}?{request.url.query}".encode()
+    ).hexdigest()
+
+
+def _mismatch():
+    return HTTPException(
+        status_code=422,
+        detail="Idempotency-Key was already used for a different request"
+    )
+
+
+async def _claim(user: str, key: str, fingerprint: str) -> bool:
+    now = datetime.now(timezone.utc)
+    async with database.AsyncSessionLocalFactory() as session:
+        claimed = await session.execute(
+            insert(database.IdempotencyKey)
+            .values(
+                user_id=user,
+                idempotency_key=key,
+                fingerprint=fingerprint,
+                state=database.IdempotencyState.IN_PROGRESS.value,
+                created_at=now,
+                expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+            )
+            .on_conflict_do_nothing()
+            .returning(database.IdempotencyKey.idempotency_key)
+        )
+        claimed = claimed.scalar_one_or_none() is not None
+        await session.commit()
+    return claimed
+
+
+async def _store(user: str, key: str, status_code: int, body):
+    async with database.AsyncSessionLocalFactory() as session:
+        entry = await session.get(database.IdempotencyKey, (user, key))
+        entry.state = database.IdempotencyState.COMPLETED.value
+        entry.response_status = status_code
+        entry.response_body = json.dumps(body)
+        entry.expires_at = datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+        await session.commit()
+
+
+async def _release(user: str, key: str):
+    async with database.AsyncSessionLocalFactory() as session:
+        await session.execute(
+            delete(database.IdempotencyKey).where(
+                database.IdempotencyKey.user_id == user,
+                database.IdempotencyKey.idempotency_key == key
+            )
+        )
+        await session.commit()
+
+
+async def _load(user: str, key: str):
+    async with database.AsyncSessionLocalFactory() as session:
+        entry = await session.execute(
+            select(database.IdempotencyKey).where(
+                database.IdempotencyKey.user_id == user,
+                database.IdempotencyKey.idempotency_key == key
+            )
+        )
+        return entry.scalars().first()
+
+
+async def _run_and_store(user: str, key: str, fingerprint: str, response: Response, handler):
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[(user, key)] = (fingerprint, future)
+    try:
+        result = await handler()
+        body = jsonable_encoder(result)
+        status_code = response.status_code or 200
+        if status_code >= 500:
+            # server side failures are safe to retry, so don't pin them to the key
+            await _release(user, key)
+        else:
+            await _store(user, key, status_code, body)
+        future.set_result((status_code, body))
+        return result
+    except BaseException as e:
+        await asyncio.shield(_release(user, key))
+        future.set_exception(e)
+        # nobody may be waiting on it, don't warn about an unretrieved exception
+        future.exception()
+        raise
+    finally:
+        _in_flight.pop((user, key), None)
+
+
+async def run_once(key: str, user: str, request: Request, response: Response, handler):
+    '''
+    Runs handler() at most once per (user, Idempotency-Key).
+    Without a key the handler just runs.
+    '''
+    if not key:
+        return await handler()
+
+    fingerprint = fingerprint_request(request)
+    deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_SECONDS
+
+    while True:
+        # the original request is running in this worker, wait on it directly
+        in_flight = _in_flight.get((user, key))
+        if in_flight:
+            in_flight_fingerprint, future = in_flight
+            if in_flight_fingerprint != fingerprint:
+                raise _mismatch()
+            remaining = deadline - asyncio.get_running_loop().time()
+            try:
+                status_code, body = await asyncio.wait_for(asyncio.shield(future), max(remaining, 0))
+            except asyncio.TimeoutError:
+                break
+            except Exception:
+                # the original failed and released the key, try to claim it ourselves
+                continue
+            response.status_code = status_code
+            return body
+
+        if await _claim(user, key, fingerprint):
+            return await _run_and_store(user, key, fingerprint, response, handler)
+
+        entry = await _load(user, key)
+        if entry is None:
+            # released between our claim and load, try again
+            continue
+        if entry.fingerprint != fingerprint:
+            raise _mismatch()
+        if entry.expires_at < datetime.now(timezone.utc):
+            # expired but not pruned yet, the key is free again
+            await _release(user, key)
+            continue
+        if entry.state == database.IdempotencyState.COMPLETED.value:
+            response.status_code = entry.response_status
+            return json.loads(entry.response_body)
+        if entry.created_at < datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_STALE_SECONDS):
+            # the request holding the key died without releasing it
+            await _release(user, key)
+            continue
+
+        # still running in another worker
+        if asyncio.get_running_loop().time() >= deadline:
+            break
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    raise HTTPException(
+        status_code=409,
+        detail="A request with this Idempotency-Key is still in progress"
+    )
+
+
+async def prune_expired():
+    '''
+    Deletes expired keys and their stored responses, from one worker at a time.
+    '''
+    async with database.advisory_lock(IDEMPOTENCY_PRUNE_LOCK_NAME) as acquired:
+        if not acquired:
+            return
+        async with database.AsyncSessionLocalFactory() as session:
+            await session.execute(
+                delete(database.IdempotencyKey)
+                .where(database.IdempotencyKey.expires_at < datetime.now(timezone.utc))
+            )
+            await session.commit()
+
+
+async def run_idempotency_prune():
+    '''
+    Prunes expired idempotency keys forever, every IDEMPOTENCY_PRUNE_INTERVAL_SECONDS.
+    '''
+    while True:
+        try:
+            await prune_expired()
+        except Exception as e:
+            print(f"Idempotency key prune failed: {e}")
+        await asyncio.sleep(IDEMPOTENCY_PRUNE_INTERVAL_SECONDS)
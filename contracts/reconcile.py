@@ -0,0 +1,233 @@
+'''
+Background reconciler that checks escrow legs against the ledger.
+
+Each pass takes a batch of wallets that own unverified legs, reads every escrow
+they hold with paginated account_objects calls, and matches them to legs by
+condition. Legs that should still be on the ledger but are not, and legs the
+database has settled, are looked up in the wallet's account_tx history.
+The cost of a pass grows with the number of wallets, not contracts.
+
+Mismatches the ledger settles are repaired (a leg the ledger finished or
+cancelled gets that state), anything else is flagged on the leg in
+ledger_mismatch. Legs whose settlement has been seen on the ledger are marked
+verified and never checked again.
+Only one worker runs a pass at a time, through a postgres advisory lock.
+'''
+import asyncio
+import os
+from sqlalchemy import case, update, bindparam
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+from database import database
+import xrpledger.smart_contracts as xrp
+
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "300"))
+# wallets checked per pass
+RECONCILE_ACCOUNT_BATCH_SIZE = int(os.getenv("RECONCILE_ACCOUNT_BATCH_SIZE", "50"))
+# account_tx pages read per wallet when looking for finished / cancelled escrows
+RECONCILE_TX_PAGES = int(os.getenv("RECONCILE_TX_PAGES", "5"))
+
+RECONCILE_LOCK_NAME = "contracts.reconcile"
+
+# legs whose escrow should still be on the ledger
+LIVE_STATES = {
+    database.EscrowState.LOCKED.value,
+    database.EscrowState.FORFEITED.value,
+    database.EscrowState.FINISHING.value,
+    database.EscrowState.CANCELLING.value,
+}
+# ledger outcome -> leg state
+SETTLED_STATES = {
+    "finish": database.EscrowState.FINISHED.value,
+    "cancel": database.EscrowState.CANCELLED.value,
+}
+
+proposer = aliased(database.User)
+courier = aliased(database.User)
+# payment legs are owned by the proposer, the collateral by the courier
+LEG_OWNER = case(
+    (database.EscrowLeg.leg == "collateral", courier.wallet_address),
+    else_=proposer.wallet_address,
+).label("owner")
+
+# wallets are checked in address order, picking up where the last pass left off
+_next_account = ""
+
+
+def _unverified_legs():
+    return (
+        select(database.EscrowLeg, LEG_OWNER)
+        .join(database.Contract, database.Contract.contract_id == database.EscrowLeg.contract_id)
+        .join(proposer, proposer.user_id == database.Contract.proposer_id)
+        .join(courier, courier.user_id == database.Contract.courier_id)
+        .where(database.EscrowLeg.verified.is_(False))
+    )
+
+
+async def _next_accounts(session) -> list:
+    global _next_account
+    owners = _unverified_legs().with_only_columns(LEG_OWNER).subquery()
+    accounts = await session.execute(
+        select(owners.c.owner)
+        .where(owners.c.owner > _next_account)
+        .distinct()
+        .order_by(owners.c.owner)
+        .limit(RECONCILE_ACCOUNT_BATCH_SIZE)
+    )
+    accounts = accounts.scalars().all()
+    # wrap around once the end is reached
+    _next_account = accounts[-1] if len(accounts) == RECONCILE_ACCOUNT_BATCH_SIZE else ""
+    return accounts
+
+
+def _flag(escrow_leg, mismatch: str):
+    if escrow_leg.ledger_mismatch != mismatch:
+        print(f"Reconcile: {escrow_leg.leg} escrow of contract {escrow_leg.contract_id}: {mismatch}")
+    escrow_leg.ledger_mismatch = mismatch
+
+
+def _apply_settlement(escrow_leg, outcome: str):
+    '''
+    Squares a leg that is gone from the ledger with how the ledger settled it (None if unknown).
+    '''
+    if outcome is None:
+        _flag(escrow_leg, "escrow is not on the ledger and no finish / cancel was found")
+        return
+
+    settled_state = SETTLED_STATES[outcome]
+    if escrow_leg.state in LIVE_STATES:
+        # the ledger went through but the result was never recorded, take the ledger's word
+        print(
+            f"Reconcile: {escrow_leg.leg} escrow of contract {escrow_leg.contract_id} "
+            f"was {escrow_leg.state}, ledger has it {settled_state}"
+        )
+        escrow_leg.state = settled_state
+    elif escrow_leg.state != settled_state:
+        _flag(escrow_leg, f"recorded as {escrow_leg.state} but the ledger has it {settled_state}")
+        return
+    escrow_leg.verified = True
+    escrow_leg.ledger_mismatch = None
+
+
+def _snapshot(escrow_leg):
+    return escrow_leg.state, escrow_leg.verified, escrow_leg.ledger_mismatch
+
+
+async def reconcile_accounts(legs: list, accounts: list) -> dict:
+    '''
+    Checks legs, as (EscrowLeg, owner address) rows, against the ledger escrows of their owners.
+    Changes are made on the legs for the caller to save.
+    Returns counts of what was found.
+    '''
+    ledger_escrows = await xrp.fetch_escrows(accounts)
+
+    counts = {"checked": len(legs), "repaired": 0, "flagged": 0, "orphaned": 0}
+    known_conditions = {(owner, escrow_leg.condition) for escrow_leg, owner in legs}
+    on_ledger = set()
+    for owner, escrows in ledger_escrows.items():
+        for escrow in escrows:
+            condition = escrow.get("Condition", "").upper()
+            on_ledger.add((owner, condition))
+            if (owner, condition) not in known_conditions:
+                counts["orphaned"] += 1
+                print(f"Reconcile: escrow {escrow.get('index')} of {owner} matches no contract")
+
+    # legs to look up in the transaction history, by owner
+    missing = {}
+    for escrow_leg, owner in legs:
+        present = (owner, escrow_leg.condition) in on_ledger
+        if escrow_leg.state in LIVE_STATES and present:
+            escrow_leg.ledger_mismatch = None
+        elif escrow_leg.state == database.EscrowState.CANCELLED.value and present:
+            # the cancel never went through, queue it again
+            _flag(escrow_leg, "recorded as CANCELLED but the escrow is still on the ledger, requeued")
+            escrow_leg.state = database.EscrowState.CANCELLING.value
+        elif present:
+            _flag(escrow_leg, f"recorded as {escrow_leg.state} but the escrow is still on the ledger")
+        else:
+            missing.setdefault(owner, []).append(escrow_leg)
+
+    owners = list(missing)
+    settlements = await asyncio.gather(*[
+        xrp.fetch_escrow_settlements(
+            owner, {escrow_leg.sequence for escrow_leg in missing[owner]}, RECONCILE_TX_PAGES
+        ) for owner in owners
+    ])
+    for owner, owner_settlements in zip(owners, settlements):
+        for escrow_leg in missing[owner]:
+            state = escrow_leg.state
+            _apply_settlement(escrow_leg, owner_settlements.get(escrow_leg.sequence))
+            if escrow_leg.state != state:
+                counts["repaired"] += 1
+
+    counts["flagged"] = sum(1 for escrow_leg, _ in legs if escrow_leg.ledger_mismatch)
+    return counts
+
+
+async def _save(session, legs: list, snapshots: dict):
+    '''
+    Writes back the legs that changed, unless settlement or the sweeper moved them on in the meantime.
+    '''
+    table = database.EscrowLeg.__table__
+    changed = [
+        {
+            "b_contract_id": escrow_leg.contract_id,
+            "b_leg": escrow_leg.leg,
+            "b_seen_state": snapshots[(escrow_leg.contract_id, escrow_leg.leg)][0],
+            "state": escrow_leg.state,
+            "verified": escrow_leg.verified,
+            "ledger_mismatch": escrow_leg.ledger_mismatch,
+        }
+        for escrow_leg, _ in legs
+        if _snapshot(escrow_leg) != snapshots[(escrow_leg.contract_id, escrow_leg.leg)]
+    ]
+    if changed:
+        await session.execute(
+            update(table).where(
+                table.c.contract_id == bindparam("b_contract_id"),
+                table.c.leg == bindparam("b_leg"),
+                table.c.state == bindparam("b_seen_state"),
+            ),
+            changed
+        )
+
+
+async def reconcile_ledger():
+    '''
+    Runs one reconciler pass, unless another worker is already running one.
+    '''
+    async with database.advisory_lock(RECONCILE_LOCK_NAME) as acquired:
+        if not acquired:
+            return
+        async with database.AsyncSessionLocalFactory() as session:
+            accounts = await _next_accounts(session)
+            if not accounts:
+                return
+            legs = await session.execute(_unverified_legs().where(LEG_OWNER.in_(accounts)))
+            legs = legs.all()
+        snapshots = {(escrow_leg.contract_id, escrow_leg.leg): _snapshot(escrow_leg) for escrow_leg, _ in legs}
+
+        # no session is held while the ledger is read
+        counts = await reconcile_accounts(legs, accounts)
+
+        async with database.AsyncSessionLocalFactory() as session:
+            await _save(session, legs, snapshots)
+            await session.commit()
+        if counts["repaired"] or counts["flagged"] or counts["orphaned"]:
+            print(
+                f"Reconcile: checked {counts['checked']} escrows across {len(accounts)} wallets, "
+                f"repaired {counts['repaired']}, flagged {counts['flagged']}, orphaned {counts['orphaned']}"
+            )
+
+
+async def run_reconciler():
+    '''
+    Runs the ledger reconciler forever, every RECONCILE_INTERVAL_SECONDS.
+    '''
+    while True:
+        try:
+            await reconcile_ledger()
+        except Exception as e:
+            print(f"Ledger reconcile failed: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
@@ -0,0 +1,145 @@
+'''
+Background job that archives settled contracts.
+
+COMPLETED / FAILED contracts older than ARCHIVE_AFTER_DAYS are moved, with their
+escrow legs, into contracts_archive / escrow_legs_archive, so the hot tables and
+their indexes only hold contracts that can still change. A contract is only
+moved once every leg has settled and been verified against the ledger, so the
+sweeper and the reconciler never lose track of an escrow. Contract lookups,
+the user's request / delivery lists and the history export read the archive too.
+
+Contracts are moved ARCHIVE_BATCH_SIZE at a time, one short transaction each.
+Rows someone else has locked are skipped, and lock waits are capped at
+ARCHIVE_LOCK_TIMEOUT_MS, so a batch gives way to request traffic instead of
+queueing behind it. Each move is recorded in the change log, so syncing clients
+can drop the contract.
+Only one worker runs a pass at a time, through a postgres advisory lock.
+'''
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, insert, exists, func, or_, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.future import select
+
+from database import database
+from contracts import events
+
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+# contracts are archived this long after they complete / fail
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_STATUSES = [
+    status.strip() for status in os.getenv("ARCHIVE_STATUSES", "COMPLETED,FAILED").split(",") if status.strip()
+]
+# contracts moved per transaction, and batches per pass
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+ARCHIVE_MAX_BATCHES = int(os.getenv("ARCHIVE_MAX_BATCHES", "50"))
+# pause between batches, so request traffic gets the tables in between
+ARCHIVE_BATCH_PAUSE_SECONDS = float(os.getenv("ARCHIVE_BATCH_PAUSE_SECONDS", "0.2"))
+ARCHIVE_LOCK_TIMEOUT_MS = int(os.getenv("ARCHIVE_LOCK_TIMEOUT_MS", "500"))
+
+ARCHIVE_LOCK_NAME = "contracts.retention"
+
+SETTLED_LEG_STATES = [database.EscrowState.FINISHED.value, database.EscrowState.CANCELLED.value]
+
+
+def _archivable(cutoff: datetime):
+    '''
+    Ids of contracts due for the archive, locked, skipping any a request holds.
+    '''
+    unsettled_leg = exists().where(
+        database.EscrowLeg.contract_id == database.Contract.contract_id,
+        or_(
+            database.EscrowLeg.state.not_in(SETTLED_LEG_STATES),
+            database.EscrowLeg.verified.is_(False),
+        ),
+    )
+    return (
+        select(database.Contract.contract_id)
+        .where(
+            database.Contract.contract_status.in_(ARCHIVE_STATUSES),
+            func.coalesce(
+                database.Contract.contract_confirm_completion, database.Contract.contract_timeout
+            ) < cutoff,
+            ~unsettled_leg,
+        )
+        .order_by(database.Contract.contract_id)
+        .limit(ARCHIVE_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def _copy(table, archive, contract_ids: list):
+    columns = [column.name for column in table.columns]
+    return insert(archive).from_select(
+        columns,
+        select(*table.columns).where(table.c.contract_id.in_(contract_ids)),
+    )
+
+
+async def archive_batch(cutoff: datetime) -> int:
+    '''
+    Moves one batch of contracts into the archive.
+    Returns the number of contracts moved.
+    '''
+    async with database.AsyncSessionLocalFactory() as session:
+        await session.execute(text(f"SET LOCAL lock_timeout = {ARCHIVE_LOCK_TIMEOUT_MS}"))
+        contract_ids = await session.execute(_archivable(cutoff))
+        contract_ids = contract_ids.scalars().all()
+        if not contract_ids:
+            return 0
+
+        await session.execute(_copy(database.EscrowLeg.__table__, database.escrow_legs_archive, contract_ids))
+        await session.execute(_copy(database.Contract.__table__, database.contracts_archive, contract_ids))
+        # legs go with their contract
+        moved = await session.execute(
+            delete(database.Contract)
+            .where(database.Contract.contract_id.in_(contract_ids))
+            .returning(
+                database.Contract.contract_id, database.Contract.contract_status,
+                database.Contract.proposer_id, database.Contract.courier_id,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await events.record(session, [
+            events.event(contract_id, events.ARCHIVED, contract_status, proposer_id, courier_id)
+            for contract_id, contract_status, proposer_id, courier_id in moved.all()
+        ])
+        await session.commit()
+    return len(contract_ids)
+
+
+async def archive_settled_contracts():
+    '''
+    Runs one archive pass, unless another worker is already running one.
+    '''
+    async with database.advisory_lock(ARCHIVE_LOCK_NAME) as acquired:
+        if not acquired:
+            return
+        cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+        archived = 0
+        for _ in range(ARCHIVE_MAX_BATCHES):
+            try:
+                moved = await archive_batch(cutoff)
+            except DBAPIError as e:
+                # most likely the lock timeout, the rest waits for the next pass
+                print(f"Contract archive batch gave way: {e}")
+                break
+            archived += moved
+            if moved < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE_SECONDS)
+        if archived:
+            print(f"Contract archive: moved {archived} contracts")
+
+
+async def run_contract_archiver():
+    '''
+    Runs the contract archiver forever, every ARCHIVE_INTERVAL_SECONDS.
+    '''
+    while True:
+        try:
+            await archive_settled_contracts()
+        except Exception as e:
+            print(f"Contract archive failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
@@ -0,0 +1,127 @@
+'''
+Response models for contract payloads.
+
+Listing endpoints select just the columns below (plus the assigned courier's stats),
+build the models straight from the row tuples, then hand them to orjson as
+plain dicts. That skips loading full ORM objects and FastAPI's generic
+jsonable_encoder walk over every contract.
+'''
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import union_all
+from sqlalchemy.future import select
+
+from database import database
+from contracts import analytics
+
+
+class CourierStatsOut(BaseModel):
+    '''
+    Courier reputation, from the running totals in courier_stats.
+    '''
+    courier_id: str
+    contracts_completed: int
+    contracts_failed: int
+    completion_rate: Optional[float] = None
+    on_time_ratio: Optional[float] = None
+    avg_drop_alerts: Optional[float] = None
+    avg_overtemp_alerts: Optional[float] = None
+    avg_water_events: Optional[float] = None
+
+
+class ContractOut(BaseModel):
+    '''
+    Contract payload returned by the listing and detail endpoints.
+    '''
+    contract_id: int
+    proposer_id: str
+    courier_id: Optional[str] = None
+    contract_award_time: Optional[datetime] = None
+    contract_completion_time: Optional[datetime] = None
+    contract_timeout: Optional[datetime] = None
+    contractStatus: str
+    required_collateral: float
+    base_price: float
+    t1_bonus: float
+    t2_bonus: float
+    title: str
+    description: str
+    courier_stats: Optional[CourierStatsOut] = None
+
+    @classmethod
+    def from_row(cls, row) -> "ContractOut":
+        # rows come straight from select_contracts(), no need to validate them again
+        fields = dict(zip(CONTRACT_FIELDS, row[:len(CONTRACT_COLUMNS)]))
+        stats = row[len(CONTRACT_COLUMNS):]
+        fields["courier_stats"] = analytics.stats_from_row(stats) if stats else None
+        return cls.model_construct(**fields)
+
+
+# Columns to select for a ContractOut, in field order
+CONTRACT_COLUMNS = (
+    database.Contract.contract_id,
+    database.Contract.proposer_id,
+    database.Contract.courier_id,
+    database.Contract.contract_award_time,
+    database.Contract.contract_completion_time,
+    database.Contract.contract_timeout,
+    database.Contract.contract_status,
+    database.Contract.required_collateral,
+    database.Contract.base_price,
+    database.Contract.t1_bonus,
+    database.Contract.t2_bonus,
+    database.Contract.contract_title,
+    database.Contract.contract_description,
+)
+CONTRACT_FIELDS = tuple(ContractOut.model_fields)[:len(CONTRACT_COLUMNS)]
+
+
+def select_contracts(courier_stats: bool = True, contracts=None):
+    '''
+    Select for ContractOut rows, with the assigned courier's stats joined in,
+    so the proposer can see who is delivering.
+    Open contracts have no courier yet, so their listings leave the join out.
+    Reads the contracts table, or `contracts` (eg. database.contracts_archive) when given.
+    '''
+    if contracts is None:
+        contracts = database.Contract.__table__
+    columns = [contracts.c[column.key] for column in CONTRACT_COLUMNS]
+    if not courier_stats:
+        return select(*columns)
+    return select(*columns, *analytics.COURIER_STATS_COLUMNS).outerjoin(
+        database.CourierStats,
+        database.CourierStats.courier_id == contracts.c.courier_id
+    )
+
+
+def select_user_contracts(role: str, user: str):
+    '''
+    Select for ContractOut rows of every contract where `role` ("proposer_id" /
+    "courier_id") is the user, archived contracts included.
+    '''
+    return union_all(*(
+        select_contracts(contracts=contracts).where(contracts.c[role] == user)
+        for contracts in (database.Contract.__table__, database.contracts_archive)
+    ))
+
+
+def orjson_response(content, response: Response) -> ORJSONResponse:
+    '''
+    ORJSONResponse carrying the headers set on the endpoint's injected response
+    (eg. the renewed access token cookie), which FastAPI drops when an endpoint
+    returns a response of its own.
+    '''
+    orjson_response = ORJSONResponse(content, status_code=response.status_code or 200)
+    orjson_response.raw_headers.extend(response.raw_headers)
+    return orjson_response
+
+
+def contract_response(row, response: Response) -> ORJSONResponse:
+    return orjson_response(ContractOut.from_row(row).__dict__, response)
+
+
+def contract_list_response(rows, response: Response) -> ORJSONResponse:
+    return orjson_response([ContractOut.from_row(row).__dict__ for row in rows], response)
@@ -0,0 +1,265 @@
+'''
+Settlement engine for contracts that the proposer has confirmed as completed.
+
+The payout plan is computed once from the sensor data and stored as the state of
+each of the contract's escrow legs, then every pending finish / cancel is
+submitted to the ledger concurrently. Legs that succeed are recorded straight away, so a retry
+after a partial failure only resubmits the legs that are still pending.
+Leg states are only written where the database still holds the state this
+request saw, so concurrent confirms and the expiry sweeper never overwrite each other.
+
+Before a leg goes to the ledger, the request submitting it takes a lease on it
+(claimed_until), so a second confirm or sweeper pass arriving in the meantime
+skips it instead of submitting it twice. The lease is released once the outcome
+is saved. If the holder dies, the leg can be claimed again once the lease runs out.
+'''
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, bindparam, or_, tuple_
+from sqlalchemy.future import select
+
+from database import database
+import xrpledger.smart_contracts as xrp
+
+# Escrow legs of a contract. The first three are signed by the proposer,
+# the collateral is signed by the courier.
+PAYMENT_LEGS = ["base", "t1", "t2"]
+ESCROW_LEGS = PAYMENT_LEGS + ["collateral"]
+
+# Most drop alerts the courier can have and still earn each payment leg.
+# More than the base tier also forfeits the courier's collateral to the proposer.
+DROP_TIERS = {
+    "t2": 2,
+    "t1": 4,
+    "base": 6,
+}
+
+PENDING_STATES = {
+    database.EscrowState.FINISHING.value: "finish",
+    database.EscrowState.CANCELLING.value: "cancel",
+}
+
+# how long a request may hold the legs it submits, well past the ledger deadlines
+SETTLEMENT_LEASE_SECONDS = float(os.getenv("SETTLEMENT_LEASE_SECONDS", "300"))
+
+
+def plan_payout(sensor_data: database.SensorData) -> dict:
+    '''
+    Computes the payout plan from the sensor data.
+    Returns {leg: EscrowState} with FINISHING / CANCELLING for legs to submit,
+    and FORFEITED for payment legs the courier did not earn (they go back to
+    the proposer once the escrow expires).
+    No sensor data defaults to full payout.
+    '''
+    drops = sensor_data.drop_alerts if sensor_data else 0
+
+    plan = {}
+    for leg in PAYMENT_LEGS:
+        if drops <= DROP_TIERS[leg]:
+            plan[leg] = database.EscrowState.FINISHING
+        else:
+            plan[leg] = database.EscrowState.FORFEITED
+
+    if drops > DROP_TIERS["base"]:
+        # give the courier's collateral to the proposer
+        plan["collateral"] = database.EscrowState.FINISHING
+    else:
+        # return the collateral to the courier
+        plan["collateral"] = database.EscrowState.CANCELLING
+    return plan
+
+
+def new_legs(contract_id: int, payment_escrows: list, collateral_escrow: list) -> list:
+    '''
+    Builds the escrow_legs rows for a freshly accepted contract, from the
+    [sequences, conditions, fulfillments] returned by xrp.create_escrow.
+    Either side may be None, or hold fewer escrows if creating them failed part way.
+    '''
+    rows = []
+    for legs, (sequences, conditions, fulfillments) in (
+        (PAYMENT_LEGS, payment_escrows or ([], [], [])),
+        (["collateral"], collateral_escrow or ([], [], [])),
+    ):
+        for leg, sequence, condition, fulfillment in zip(legs, sequences, conditions, fulfillments):
+            rows.append({
+                "contract_id": contract_id,
+                "leg": leg,
+                "sequence": int(sequence),
+                "condition": condition,
+                "fulfillment": fulfillment,
+                "state": database.EscrowState.LOCKED.value,
+            })
+    return rows
+
+
+async def load_legs(session, contract_ids: list) -> dict:
+    '''
+    Returns {contract_id: {leg: EscrowLeg}} for the given contracts.
+    The legs are detached from the session, their states are only written by save_states.
+    '''
+    legs = {}
+    if not contract_ids:
+        return legs
+    rows = await session.execute(
+        select(database.EscrowLeg).where(database.EscrowLeg.contract_id.in_(contract_ids))
+    )
+    for escrow_leg in rows.scalars().all():
+        session.expunge(escrow_leg)
+        legs.setdefault(escrow_leg.contract_id, {})[escrow_leg.leg] = escrow_leg
+    return legs
+
+
+def snapshot(escrow_legs) -> dict:
+    '''
+    Returns {(contract_id, leg): state} for the given legs, to guard save_states with.
+    '''
+    return {(escrow_leg.contract_id, escrow_leg.leg): escrow_leg.state for escrow_leg in escrow_legs}
+
+
+async def save_states(session, escrow_legs, seen: dict):
+    '''
+    Writes back the legs whose state changed since the snapshot `seen`, in one executemany.
+    A leg another request or the sweeper moved on in the meantime is left alone.
+    '''
+    table = database.EscrowLeg.__table__
+    changed = [
+        {
+            "b_contract_id": escrow_leg.contract_id,
+            "b_leg": escrow_leg.leg,
+            "b_seen_state": seen[(escrow_leg.contract_id, escrow_leg.leg)],
+            "state": escrow_leg.state,
+        }
+        for escrow_leg in escrow_legs
+        if escrow_leg.state != seen[(escrow_leg.contract_id, escrow_leg.leg)]
+    ]
+    if changed:
+        await session.execute(
+            update(table).where(
+                table.c.contract_id == bindparam("b_contract_id"),
+                table.c.leg == bindparam("b_leg"),
+                table.c.state == bindparam("b_seen_state"),
+            ),
+            changed
+        )
+
+
+async def claim_pending(session, escrow_legs) -> tuple:
+    '''
+    Leases the pending legs among escrow_legs that still hold the state they were
+    read with, and that no one else holds a live lease on.
+    Returns (the legs claimed, the lease to release them with).
+    '''
+    now = datetime.now(timezone.utc)
+    lease = now + timedelta(seconds=SETTLEMENT_LEASE_SECONDS)
+    pending = [escrow_leg for escrow_leg in escrow_legs if escrow_leg.state in PENDING_STATES]
+    if not pending:
+        return [], lease
+    claimed = await session.execute(
+        update(database.EscrowLeg)
+        .where(
+            tuple_(database.EscrowLeg.contract_id, database.EscrowLeg.leg, database.EscrowLeg.state).in_([
+                (escrow_leg.contract_id, escrow_leg.leg, escrow_leg.state) for escrow_leg in pending
+            ]),
+            or_(database.EscrowLeg.claimed_until.is_(None), database.EscrowLeg.claimed_until < now),
+        )
+        .values(claimed_until=lease)
+        .returning(database.EscrowLeg.contract_id, database.EscrowLeg.leg)
+        .execution_options(synchronize_session=False)
+    )
+    claimed = set(claimed.all())
+    return [escrow_leg for escrow_leg in pending if (escrow_leg.contract_id, escrow_leg.leg) in claimed], lease
+
+
+async def release_claims(session, escrow_legs, lease: datetime):
+    '''
+    Releases the leases taken by claim_pending, unless they ran out and someone else took the leg over.
+    '''
+    keys = [(escrow_leg.contract_id, escrow_leg.leg) for escrow_leg in escrow_legs]
+    if keys:
+        await session.execute(
+            update(database.EscrowLeg)
+            .where(
+                tuple_(database.EscrowLeg.contract_id, database.EscrowLeg.leg).in_(keys),
+                database.EscrowLeg.claimed_until == lease,
+            )
+            .values(claimed_until=None)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def apply_plan(legs: dict, plan: dict):
+    '''
+    Stores the payout plan on the legs, unless a plan was already stored by
+    an earlier (partially failed) attempt.
+    '''
+    if any(escrow_leg.state != database.EscrowState.LOCKED.value for escrow_leg in legs.values()):
+        return
+    for leg, state in plan.items():
+        legs[leg].state = state.value
+
+
+def pending_legs(legs: dict) -> list:
+    '''
+    Returns the legs that still have to be submitted.
+    '''
+    return [leg for leg, escrow_leg in legs.items() if escrow_leg.state in PENDING_STATES]
+
+
+def is_settled(legs: dict) -> bool:
+    return not pending_legs(legs)
+
+
+def build_actions(legs: dict, proposer_seed: str, courier_seed: str) -> list:
+    '''
+    Builds the ledger actions for every pending leg.
+    Returns a list of (leg, action) pairs for xrp.submit_escrow_batch.
+    '''
+    actions = []
+    for leg in pending_legs(legs):
+        escrow_leg = legs[leg]
+        actions.append((leg, {
+            "seed": courier_seed if leg == "collateral" else proposer_seed,
+            "action": PENDING_STATES[escrow_leg.state],
+            "sequence": escrow_leg.sequence,
+            "condition": escrow_leg.condition,
+            "fulfillment": escrow_leg.fulfillment,
+        }))
+    return actions
+
+
+def record_results(legs: dict, actions: list, results: list) -> dict:
+    '''
+    Records the outcome of each submitted leg.
+    Returns {leg: error message} for the legs that failed, which stay pending.
+    '''
+    errors = {}
+    for (leg, action), (succeeded, result) in zip(actions, results):
+        if succeeded:
+            if action["action"] == "finish":
+                legs[leg].state = database.EscrowState.FINISHED.value
+            else:
+                legs[leg].state = database.EscrowState.CANCELLED.value
+        else:
+            errors[leg] = str(result)
+    return errors
+
+
+async def submit_pending_legs(legs: dict, proposer_seed: str, courier_seed: str) -> dict:
+    '''
+    Submits every pending leg concurrently and records the outcome of each.
+    Only pass legs this request has claimed.
+    Returns {leg: error message} for the legs that failed.
+    '''
+    actions = build_actions(legs, proposer_seed, courier_seed)
+    if not actions:
+        return {}
+    try:
+        results = await xrp.submit_escrow_batch([action for _, action in actions])
+    except Exception as e:
+        # the plan is already stored, the legs stay pending for a retry
+        results = [(False, e)] * len(actions)
+    return record_results(legs, actions, results)
+
+
+def leg_states(legs: dict) -> dict:
+    return {leg: escrow_leg.state for leg, escrow_leg in legs.items()}
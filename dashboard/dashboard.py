@@ -0,0 +1,131 @@
+'''
+Composite dashboard endpoint.
+
+One call returns what the frontend otherwise fetches from /auth/me,
+/contracts/my-contract-requests, /contracts/my-contract-deliveries and
+/contracts/open-contracts: one token check, one session, and a single query for
+all the contract lists, with the ledger balance lookup running alongside it.
+'''
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import APIRouter, Request, Response, Depends
+from sqlalchemy.future import select
+from sqlalchemy import or_, union_all
+
+from auth import auth
+from database import database
+from contracts.schemas import ContractOut, select_contracts, orjson_response
+import xrpledger.smart_contracts as xrp
+
+router = APIRouter()
+
+SECTIONS = ("me", "requests", "deliveries", "open")
+
+
+async def get_balance(wallet_address: str) -> dict:
+    try:
+        return {"account_balance": await xrp.check_balance(wallet_address)}
+    except Exception as e:
+        # the rest of the dashboard is still worth showing
+        return {"account_balance": None, "balance_error": str(e)}
+
+
+async def get_contracts(session, user: str, sections: set) -> dict:
+    '''
+    Fetches every requested contract list in one query, then splits the rows by section.
+    '''
+    now = datetime.now(timezone.utc)
+    filters = []
+    if "requests" in sections:
+        filters.append(database.Contract.proposer_id == user)
+    if "deliveries" in sections:
+        filters.append(database.Contract.courier_id == user)
+    if "open" in sections:
+        filters.append(
+            (database.Contract.contract_status == database.ContractStatus.OPEN.value) &
+            (database.Contract.contract_timeout > now)
+        )
+    if not filters:
+        return {}
+
+    queries = [select_contracts().where(or_(*filters))]
+    # the user's settled contracts may have moved to the archive
+    archive = database.contracts_archive
+    archived = [
+        archive.c[role] == user
+        for section, role in (("requests", "proposer_id"), ("deliveries", "courier_id"))
+        if section in sections
+    ]
+    if archived:
+        queries.append(select_contracts(contracts=archive).where(or_(*archived)))
+
+    rows = await session.execute(union_all(*queries))
+    contracts = {section: [] for section in sections if section != "me"}
+    for row in rows.all():
+        contract = ContractOut.from_row(row)
+        if "requests" in contracts and contract.proposer_id == user:
+            contracts["requests"].append(contract.__dict__)
+        if "deliveries" in contracts and contract.courier_id == user:
+            contracts["deliveries"].append(contract.__dict__)
+        if (
+            "open" in contracts
+            and contract.contractStatus == database.ContractStatus.OPEN.value
+            and contract.contract_timeout > now
+        ):
+            contracts["open"].append(contract.__dict__)
+    return contracts
+
+
+@router.get("/", tags=["Dashboard"])
+async def get_dashboard(
+    request: Request,
+    response: Response,
+    sections: Optional[str] = None,
+    _auth: None=Depends(auth.check_and_renew_access_token)
+    ):
+    '''
+    Returns the dashboard for the current user.
+    sections is a comma separated subset of me, requests, deliveries and open (default: all of them),
+    so clients only pay for what they render.
+    '''
+    user = auth.get_current_user(request)['sub']
+    wanted = set(SECTIONS)
+    if sections:
+        wanted = {section.strip() for section in sections.split(",") if section.strip()}
+        unknown = wanted - set(SECTIONS)
+        if unknown:
+            response.status_code = 400
+            return {"detail": f"Unknown sections: {sorted(unknown)}, expected some of {list(SECTIONS)}"}
+
+    async with database.AsyncSessionLocalFactory() as session:
+        balance = None
+        if "me" in wanted:
+            wallet_address = await session.execute(
+                select(database.User.wallet_address).where(database.User.user_id == user)
+            )
+            # start the ledger lookup before the contract query, so they overlap
+            balance = asyncio.ensure_future(get_balance(wallet_address.scalar_one()))
+
+        try:
+            contracts = await get_contracts(session, user, wanted)
+        except BaseException:
+            if balance is not None:
+                balance.cancel()
+            raise
+
+    # the connection goes back to the pool before waiting on the ledger
+    if balance is not None:
+        balance = await balance
+
+    dashboard = {}
+    if "me" in wanted:
+        dashboard["me"] = {"username": user, **balance}
+    for section, key in (
+        ("requests", "contract_requests"),
+        ("deliveries", "contract_deliveries"),
+        ("open", "open_contracts"),
+    ):
+        if section in wanted:
+            dashboard[key] = contracts[section]
+    return orjson_response(dashboard, response)
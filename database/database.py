@@ -1,7 +1,10 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, TIMESTAMP
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Float, Boolean, TIMESTAMP, Index, Table, text, func
+from contextlib import asynccontextmanager
 import enum
+import os
+import zlib
 
 # TODO: REPLACE WITH REAL ENV VARS
 DATABASE_URL = (
@@ -45,6 +48,13 @@ class SensorData(Base):
     water_events    = Column(Integer, nullable=False, index=True)
     longitude       = Column(Float, nullable=False, index=True)
     latitude        = Column(Float, nullable=False, index=True)
+    # duplicate suppression window, see sensor/dedupe.py
+    last_seq        = Column(BigInteger, nullable=True)
+    seq_window      = Column(BigInteger, nullable=True)
+    # last reading, rows of sensors that stay quiet are purged (see sensor/retention.py)
+    updated_at      = Column(
+        TIMESTAMP(timezone=True), nullable=False, server_default=text("now()"), onupdate=func.now()
+    )
 
 class ContractStatus(enum.Enum):
     """
@@ -52,8 +62,26 @@ class ContractStatus(enum.Enum):
     """
     OPEN = "OPEN"
     FULFILLMENT = "FULFILLMENT"
+    # confirmed by the proposer, escrows being settled
+    SETTLING = "SETTLING"
     COMPLETED = "COMPLETED"
     FAILED = "FAILED"
+    EXPIRED = "EXPIRED"
+
+
+class EscrowState(enum.Enum):
+    """
+    Escrow leg state enum for the database.
+    LOCKED once the escrow is created, then the settlement plan moves each leg to
+    FINISHING / CANCELLING (pending submission) or FORFEITED (left to expire),
+    and a successful submission moves it to FINISHED / CANCELLED.
+    """
+    LOCKED = "LOCKED"
+    FINISHING = "FINISHING"
+    CANCELLING = "CANCELLING"
+    FORFEITED = "FORFEITED"
+    FINISHED = "FINISHED"
+    CANCELLED = "CANCELLED"
 
 
 class Contract(Base):
@@ -61,6 +89,18 @@ class Contract(Base):
     Contract model for the database.
     """
     __tablename__ = "contracts"
+    __table_args__ = (
+        # due contracts for the expiry sweeper
+        Index(
+            "contracts_due_idx", "contract_timeout",
+            postgresql_where=text("contract_status IN ('OPEN', 'FULFILLMENT')"),
+        ),
+        # a sensor can only be tracking one contract at a time
+        Index(
+            "contracts_active_sensor_idx", "sensor_id", unique=True,
+            postgresql_where=text("contract_status IN ('FULFILLMENT', 'SETTLING')"),
+        ),
+    )
 
     # Contract ID
     contract_id = Column(Integer, primary_key=True, nullable=False, index=True)
@@ -86,21 +126,6 @@ class Contract(Base):
     t1_bonus                = Column(Float, nullable=False, index=True)
     t2_bonus                = Column(Float, nullable=False, index=True)
 
-    # Escrow keys
-    base_lock           = Column(String)
-    t1_lock             = Column(String)
-    t2_lock             = Column(String)
-    collateral_lock     = Column(String)
-    base_key            = Column(String)
-    t1_key              = Column(String)
-    t2_key              = Column(String)
-    collateral_key      = Column(String)
-    base_txn_id         = Column(String)
-    t1_txn_id           = Column(String)
-    t2_txn_id           = Column(String)
-    collateral_txn_id   = Column(String)
-
-
     # Sensor
     sensor_id = Column(
         String, ForeignKey("user_sensors.sensor_id"), nullable=True, index=True
@@ -111,10 +136,199 @@ class Contract(Base):
     contract_description   = Column(String, nullable=False)
 
 
-# Create async engine
-engine = create_async_engine(DATABASE_URL, echo=True)
+class EscrowLeg(Base):
+    """
+    Escrow leg model for the database, one row per escrow a contract holds on the ledger
+    (base / t1 / t2 signed by the proposer, collateral signed by the courier).
+    Kept out of the contracts table so listings never read the escrow secrets.
+    """
+    __tablename__ = "escrow_legs"
+    __table_args__ = (
+        # bonus escrows left to expire
+        Index(
+            "escrow_legs_forfeited_idx", "contract_id",
+            postgresql_where=text("state = 'FORFEITED'"),
+        ),
+        # escrow cancellations queued by the expiry sweeper
+        Index(
+            "escrow_legs_cancel_queue_idx", "contract_id",
+            postgresql_where=text("state = 'CANCELLING'"),
+        ),
+        # legs the ledger reconciler still has to check
+        Index(
+            "escrow_legs_unverified_idx", "contract_id",
+            postgresql_where=text("NOT verified"),
+        ),
+    )
+    contract_id = Column(
+        Integer, ForeignKey("contracts.contract_id", ondelete="CASCADE"), primary_key=True, nullable=False
+    )
+    leg         = Column(String, primary_key=True, nullable=False)
+    # offer sequence of the EscrowCreate
+    sequence    = Column(BigInteger, nullable=False)
+    condition   = Column(String, nullable=False)
+    fulfillment = Column(String, nullable=False)
+    state       = Column(String, nullable=False)
+    # set once the reconciler has seen the leg's finish / cancel on the ledger
+    verified    = Column(Boolean, nullable=False, default=False, server_default=text("false"))
+    # what the reconciler found wrong with the leg, if anything
+    ledger_mismatch = Column(String)
+    # lease held by the request submitting the leg to the ledger, see contracts/settlement.py
+    claimed_until   = Column(TIMESTAMP(timezone=True))
+
+
+def archive_table(table: Table) -> Table:
+    """
+    Archive copy of a table: the same columns, without foreign keys or secondary
+    indexes, plus when each row was archived. See contracts/retention.py.
+    """
+    return Table(
+        f"{table.name}_archive", Base.metadata,
+        *[
+            Column(column.name, column.type, primary_key=column.primary_key,
+                   nullable=column.nullable, autoincrement=False)
+            for column in table.columns
+        ],
+        Column("archived_at", TIMESTAMP(timezone=True), nullable=False, server_default=text("now()")),
+    )
+
+
+# settled contracts and their escrow legs, moved out of the hot tables
+contracts_archive = archive_table(Contract.__table__)
+escrow_legs_archive = archive_table(EscrowLeg.__table__)
+
+
+class CourierStats(Base):
+    """
+    Courier performance aggregates for the database.
+    Updated incrementally whenever a contract the courier delivered settles or fails.
+    """
+    __tablename__ = "courier_stats"
+    courier_id              = Column(String, ForeignKey("users.user_id"), primary_key=True, nullable=False)
+    contracts_completed     = Column(Integer, nullable=False, default=0)
+    contracts_failed        = Column(Integer, nullable=False, default=0)
+    contracts_on_time       = Column(Integer, nullable=False, default=0)
+    total_drop_alerts       = Column(Integer, nullable=False, default=0)
+    total_overtemp_alerts   = Column(Integer, nullable=False, default=0)
+    total_water_events      = Column(Integer, nullable=False, default=0)
+
+
+class IdempotencyState(enum.Enum):
+    """
+    Idempotency key state enum for the database.
+    """
+    IN_PROGRESS = "IN_PROGRESS"
+    COMPLETED = "COMPLETED"
+
+
+class IdempotencyKey(Base):
+    """
+    Idempotency key model for the database.
+    Stores the outcome of a request sent with an Idempotency-Key header, so retries get the same response.
+    """
+    __tablename__ = "idempotency_keys"
+    user_id         = Column(String, ForeignKey("users.user_id"), primary_key=True, nullable=False)
+    idempotency_key = Column(String, primary_key=True, nullable=False)
+    fingerprint     = Column(String, nullable=False)
+    state           = Column(String, nullable=False)
+    response_status = Column(Integer)
+    response_body   = Column(String)
+    created_at      = Column(TIMESTAMP(timezone=True), nullable=False)
+    # the stored response is pruned after this
+    expires_at      = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+
+
+
+class ContractEvent(Base):
+    """
+    Contract change log for the database, append only.
+    One row per state transition, written in the same transaction as the transition.
+    xact_id is the writing transaction's id, which is what change cursors are ordered on:
+    once every transaction below a given id has finished, no event can show up behind it.
+    """
+    __tablename__ = "contract_events"
+    __table_args__ = (
+        # changes feed, per participant and for open contracts
+        Index(
+            "contract_events_proposer_idx", "proposer_id", "xact_id", "event_id",
+            postgresql_include=["contract_id", "event_type", "contract_status"],
+        ),
+        Index(
+            "contract_events_courier_idx", "courier_id", "xact_id", "event_id",
+            postgresql_include=["contract_id", "event_type", "contract_status"],
+        ),
+        Index(
+            "contract_events_public_idx", "xact_id", "event_id",
+            postgresql_include=["contract_id", "event_type", "contract_status"],
+            postgresql_where=text("public"),
+        ),
+    )
+    event_id        = Column(BigInteger, primary_key=True, autoincrement=True)
+    xact_id         = Column(
+        BigInteger, nullable=False, server_default=text("pg_current_xact_id()::text::bigint")
+    )
+    contract_id     = Column(Integer, nullable=False)
+    event_type      = Column(String, nullable=False)
+    contract_status = Column(String, nullable=False)
+    # no foreign keys, events outlive deleted contracts
+    proposer_id     = Column(String, nullable=False)
+    courier_id      = Column(String)
+    # the contract was open before or after the event, so anyone can see it
+    public          = Column(Boolean, nullable=False)
+    created_at      = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text("now()"))
+
+
+
+class UserSession(Base):
+    """
+    Login session model for the database.
+    Every access token carries its session's id (sid), renewals keep it, so a
+    session can be ended no matter how many tokens it has been renewed into.
+    """
+    __tablename__ = "user_sessions"
+    session_id  = Column(String, primary_key=True, nullable=False)
+    user_id     = Column(String, ForeignKey("users.user_id"), nullable=False, index=True)
+    created_at  = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text("now()"))
+    # no token of the session is accepted after this
+    expires_at  = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+
+
+class RevokedToken(Base):
+    """
+    Revoked session / token ids for the database, see auth/revocation.py.
+    Rows are only needed until expires_at, after which the tokens are rejected anyway.
+    """
+    __tablename__ = "revoked_tokens"
+    token_id    = Column(String, primary_key=True, nullable=False)
+    user_id     = Column(String, nullable=False)
+    revoked_at  = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text("now()"))
+    expires_at  = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+
+# Create async engine, DB_ECHO=1 logs every statement
+engine = create_async_engine(DATABASE_URL, echo=os.getenv("DB_ECHO", "0") == "1")
 
 # Create session factory
 AsyncSessionLocalFactory = async_sessionmaker(
     bind=engine, class_=AsyncSession, expire_on_commit=False
 )
+
+
+@asynccontextmanager
+async def advisory_lock(name: str):
+    """
+    Tries to take a postgres session-level advisory lock for the duration of the block.
+    Yields whether the lock was acquired, so that a job only runs in one worker
+    across every process sharing the database.
+    """
+    key = zlib.crc32(name.encode())
+    async with engine.connect() as conn:
+        acquired = (
+            await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": key})
+        ).scalar()
+        await conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+                await conn.commit()
@@ -0,0 +1,247 @@
+'''
+Opt-in sampling profiler for requests.
+
+A fraction of requests (PROFILE_SAMPLE_RATE), requests whose path matches one of
+PROFILE_ROUTES (fnmatch patterns, eg. /contracts/*/accept-contract), and
+requests sent with an X-Profile header carrying the admin token are profiled.
+
+One background thread samples the event loop every PROFILE_INTERVAL_MS. A
+profiled request that is running gets the live stack, and one that is suspended
+gets the chain of coroutines it is awaiting. Time spent waiting on postgres or
+the ledger shows up as well as CPU (eg. bcrypt or serialization). Samples are
+folded per stack ("frame;frame;frame count" lines, as flamegraph.pl and
+speedscope read them). Each profile is written to PROFILE_DIR, which keeps the
+newest PROFILE_MAX_FILES, and the slowest
+recent ones are kept in memory for the admin endpoint.
+'''
+import asyncio
+import fnmatch
+import heapq
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ROUTES = [route.strip() for route in os.getenv("PROFILE_ROUTES", "").split(",") if route.strip()]
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# profile files kept on disk, the oldest are deleted past this
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "500"))
+# slowest profiles kept in memory, and how long they count as recent
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+PROFILE_KEEP_SECONDS = float(os.getenv("PROFILE_KEEP_SECONDS", "3600"))
+# frames deeper than this are cut off
+PROFILE_MAX_DEPTH = 128
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class RequestProfile:
+    __slots__ = ("profile_id", "method", "path", "route", "status", "started", "duration", "marker", "task", "samples")
+
+    def __init__(self, profile_id: int, method: str, path: str, marker, task):
+        self.profile_id = profile_id
+        self.method = method
+        self.path = path
+        self.route = path
+        self.status = None
+        self.started = time.time()
+        self.duration = None
+        # the middleware's own frame, everything above it in a stack belongs to the request
+        self.marker = marker
+        self.task = task
+        self.samples = Counter()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "profile_id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started": self.started,
+            "duration_ms": round(self.duration * 1000, 1),
+            "samples": sum(self.samples.values()),
+        }
+
+
+class Sampler:
+    '''
+    Samples every active request profile from a background thread.
+    '''
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.loop_thread_id = None
+        self.thread = None
+        self.ids = itertools.count(1)
+        # (duration, profile_id, profile), smallest first so the fastest is dropped
+        self.slowest = []
+
+    def start(self, profile: RequestProfile):
+        if self.thread is None:
+            self.loop_thread_id = threading.get_ident()
+            self.thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+            self.thread.start()
+        with self.lock:
+            self.active[profile.profile_id] = profile
+
+    def stop(self, profile: RequestProfile):
+        with self.lock:
+            self.active.pop(profile.profile_id, None)
+        profile.marker = None
+        profile.task = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                running = sys._current_frames().get(self.loop_thread_id)
+                running_stack = []
+                while running is not None and len(running_stack) < PROFILE_MAX_DEPTH:
+                    running_stack.append(running)
+                    running = running.f_back
+                for profile in self.active.values():
+                    stack = self._stack(profile, running_stack)
+                    if stack:
+                        profile.samples[";".join(stack)] += 1
+
+    def _stack(self, profile: RequestProfile, running_stack: list) -> list:
+        if profile.marker in running_stack:
+            # on the CPU right now, the stack from the middleware up
+            frames = running_stack[:running_stack.index(profile.marker) + 1]
+            return [_label(frame) for frame in reversed(frames)]
+
+        # suspended, follow what it is awaiting from the middleware down
+        coro = profile.task.get_coro() if profile.task is not None else None
+        stack = []
+        recording = False
+        while coro is not None and len(stack) < PROFILE_MAX_DEPTH:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+            if frame is not None:
+                recording = recording or frame is profile.marker
+                if recording:
+                    stack.append(_label(frame))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+        if stack:
+            stack.append("[awaiting]")
+        return stack
+
+    def keep(self, profile: RequestProfile):
+        now = time.time()
+        self.slowest = [entry for entry in self.slowest if now - entry[2].started < PROFILE_KEEP_SECONDS]
+        heapq.heapify(self.slowest)
+        entry = (profile.duration, profile.profile_id, profile)
+        if len(self.slowest) < PROFILE_KEEP:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def profiles(self) -> list:
+        return [profile for _, _, profile in sorted(self.slowest, reverse=True)]
+
+    def get(self, profile_id: int):
+        for _, _, profile in self.slowest:
+            if profile.profile_id == profile_id:
+                return profile
+        return None
+
+
+sampler = Sampler(PROFILE_INTERVAL_MS / 1000)
+
+
+def should_profile(scope) -> bool:
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return True
+    if PROFILE_ROUTES and any(fnmatch.fnmatchcase(scope["path"], route) for route in PROFILE_ROUTES):
+        return True
+    if ADMIN_TOKEN:
+        for name, value in scope.get("headers", ()):
+            if name == b"x-profile":
+                return hmac.compare_digest(value, ADMIN_TOKEN.encode())
+    return False
+
+
+# profile files on disk, oldest first (None until the directory has been read)
+_written = None
+_written_lock = threading.Lock()
+
+
+def write_folded(profile: RequestProfile):
+    global _written
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    route = profile.route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+    name = f"{int(profile.started * 1000)}-{profile.method}-{route}-{int(profile.duration * 1000)}ms.folded"
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path, "w") as f:
+        f.write(profile.folded())
+
+    with _written_lock:
+        if _written is None:
+            # names start with the start time, so they sort oldest first (this one included)
+            _written = deque(sorted(
+                os.path.join(PROFILE_DIR, existing)
+                for existing in os.listdir(PROFILE_DIR) if existing.endswith(".folded")
+            ))
+        else:
+            _written.append(path)
+        while len(_written) > PROFILE_MAX_FILES:
+            try:
+                os.remove(_written.popleft())
+            except FileNotFoundError:
+                pass
+
+
+class ProfilerMiddleware:
+    '''
+    ASGI middleware that profiles the requests should_profile picks.
+    Everything else goes straight through.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(
+            next(sampler.ids), scope["method"], scope["path"], sys._getframe(), asyncio.current_task()
+        )
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+            await send(message)
+
+        sampler.start(profile)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.duration = time.perf_counter() - started
+            sampler.stop(profile)
+            route = scope.get("route")
+            if route is not None:
+                profile.route = route.path
+            sampler.keep(profile)
+            try:
+                await asyncio.to_thread(write_folded, profile)
+            except OSError as e:
+                print(f"Could not write profile: {e}")
@@ -0,0 +1,163 @@
+'''
+Slow query log.
+
+Engine event hooks time every statement. Statements slower than SLOW_QUERY_MS
+are kept in a bounded in-memory log with their parameters and the route of the
+request that ran them, and the slow SELECTs get an EXPLAIN (ANALYZE, BUFFERS)
+plan captured in the background on a separate connection. The admin endpoint
+/admin/slow-queries serves the log, newest first.
+
+The plan comes from running the statement again, in a read-only transaction
+that is rolled back, under SLOW_QUERY_EXPLAIN_TIMEOUT_MS. Only one plan is
+captured at a time; slow queries that come in while one is running are logged
+without a plan.
+'''
+import asyncio
+import contextvars
+import os
+import re
+import time
+from collections import deque
+from sqlalchemy import event, text
+
+# statements slower than this are logged
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# slow queries kept per worker
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+# set to 0 to log slow queries without capturing plans
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", "5000"))
+# longest parameter value kept, longer ones are cut
+SLOW_QUERY_PARAM_LENGTH = 200
+
+# parameters never written to the log
+SECRET_PARAMS = re.compile(r"password|wallet_number|fulfillment|seed", re.IGNORECASE)
+# statements that are not safe to run again, even read only
+UNSAFE_TO_EXPLAIN = re.compile(r"advisory|pg_notify|nextval|setval", re.IGNORECASE)
+
+# the ASGI scope of the request being served, set by SlowQueryMiddleware
+current_request = contextvars.ContextVar("current_request", default=None)
+
+log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+# the plan being captured, if any
+_explain_task = None
+
+
+class SlowQueryMiddleware:
+    '''
+    ASGI middleware that makes the request's scope available to the engine hooks,
+    so slow queries can be tagged with their route.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_request.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request.reset(token)
+
+
+def _route() -> str:
+    scope = current_request.get()
+    if scope is None:
+        return "background"
+    # routing sets the matched route on the scope before the endpoint runs
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else scope['path']}"
+
+
+def _param(name: str, value):
+    if name and SECRET_PARAMS.search(name):
+        return "<redacted>"
+    value = repr(value)
+    return value if len(value) <= SLOW_QUERY_PARAM_LENGTH else value[:SLOW_QUERY_PARAM_LENGTH] + "..."
+
+
+def _params(context, parameters, executemany: bool):
+    if executemany:
+        return f"<{len(parameters)} parameter sets>"
+    names = getattr(context.compiled, "positiontup", None) or []
+    if isinstance(parameters, dict):
+        return {name: _param(name, value) for name, value in parameters.items()}
+    return [
+        _param(names[idx] if idx < len(names) else None, value)
+        for idx, value in enumerate(parameters or ())
+    ]
+
+
+def _explainable(statement: str, parameters, executemany: bool) -> bool:
+    return (
+        not executemany
+        and statement.lstrip().upper().startswith(("SELECT", "WITH"))
+        and not UNSAFE_TO_EXPLAIN.search(statement)
+    )
+
+
+async def _explain(engine, entry: dict, statement: str, parameters):
+    try:
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(slow_query_log=False)
+            await conn.execute(text("SET TRANSACTION READ ONLY"))
+            await conn.execute(text(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}"))
+            plan = await conn.exec_driver_sql(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT TEXT) {statement}", parameters
+            )
+            entry["plan"] = "\n".join(row[0] for row in plan.all())
+            await conn.rollback()
+    except Exception as e:
+        entry["plan_error"] = str(e)
+
+
+def install(engine):
+    '''
+    Adds the timing hooks to an async engine.
+    '''
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        global _explain_task
+        elapsed_ms = (time.perf_counter() - conn.info["query_started"].pop()) * 1000
+        if elapsed_ms < SLOW_QUERY_MS or not context.execution_options.get("slow_query_log", True):
+            return
+
+        entry = {
+            "time": time.time(),
+            "duration_ms": round(elapsed_ms, 1),
+            "route": _route(),
+            "statement": statement,
+            "parameters": _params(context, parameters, executemany),
+            "plan": None,
+        }
+        log.append(entry)
+        print(f"Slow query ({entry['duration_ms']} ms, {entry['route']}): {' '.join(statement.split())[:200]}")
+
+        explaining = _explain_task is not None and not _explain_task.done()
+        if SLOW_QUERY_EXPLAIN and not explaining and _explainable(statement, parameters, executemany):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            _explain_task = loop.create_task(_explain(engine, entry, statement, parameters))
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(exception_context):
+        # failed statements never reach after_cursor_execute
+        started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+        if started:
+            started.pop()
+
+
+def entries(limit: int = None) -> list:
+    '''
+    Logged slow queries, newest first.
+    '''
+    newest = list(reversed(log))
+    return newest[:limit] if limit else newest
@@ -1,8 +1,15 @@
+import asyncio
+import importlib
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from auth.auth import router as auth_router
-from contracts.contracts import router as contracts_router
-from sensor.sensor import router as sensor_router
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+
+from diagnostics.profiler import ProfilerMiddleware
+from diagnostics import slow_queries
+from database import database
 
 origins = [
     "http://localhost",
@@ -12,7 +19,74 @@ origins = [
     # Add other origins as needed
 ]
 
-app = FastAPI()
+# Routers this service can mount: name -> (module, prefix)
+ROUTERS = {
+    "auth": ("auth.auth", "/auth"),
+    "contracts": ("contracts.contracts", "/contracts"),
+    "sensor": ("sensor.sensor", "/sensors"),
+    "dashboard": ("dashboard.dashboard", "/dashboard"),
+    "admin": ("admin.admin", "/admin"),
+}
+
+# every router that checks access tokens needs the revoked token ids
+AUTH_JOBS = ["auth.revocation:run_revocation_sync"]
+
+# Background jobs that belong to each router: name -> ["module:coroutine function"]
+BACKGROUND_JOBS = {
+    "auth": AUTH_JOBS,
+    "contracts": AUTH_JOBS + [
+        "contracts.expiry:run_expiry_sweeper",
+        "contracts.reconcile:run_reconciler",
+        "contracts.retention:run_contract_archiver",
+        "contracts.idempotency:run_idempotency_prune",
+    ],
+    "sensor": AUTH_JOBS + ["sensor.alerts:listen_for_alerts", "sensor.retention:run_sensor_data_purge"],
+    "dashboard": AUTH_JOBS,
+}
+
+# Deployment profiles, eg. APP_PROFILE=ingest for workers that only take sensor data
+PROFILES = {
+    "full": ["auth", "contracts", "sensor", "dashboard", "admin"],
+    "ingest": ["sensor"],
+}
+
+
+def selected_routers() -> list:
+    '''
+    Routers to mount in this process.
+    APP_ROUTERS (comma separated names) wins over APP_PROFILE, which defaults to full.
+    Routers that aren't mounted are never imported.
+    '''
+    names = os.getenv("APP_ROUTERS")
+    if names:
+        names = [name.strip() for name in names.split(",") if name.strip()]
+    else:
+        names = PROFILES[os.getenv("APP_PROFILE", "full")]
+
+    unknown = [name for name in names if name not in ROUTERS]
+    if unknown:
+        raise ValueError(f"Unknown routers: {unknown}")
+    return names
+
+
+def load(path: str):
+    module, attr = path.split(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+mounted_routers = selected_routers()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # background jobs, each one coordinates across workers on its own
+    # (a job shared by several routers runs once)
+    jobs = dict.fromkeys(job for name in mounted_routers for job in BACKGROUND_JOBS.get(name, []))
+    background_jobs = [asyncio.create_task(load(job)()) for job in jobs]
+    yield
+    for job in background_jobs:
+        job.cancel()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,10 +96,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(auth_router, prefix="/auth")
-app.include_router(contracts_router, prefix="/contracts")
-app.include_router(sensor_router, prefix="/sensors")
+# compress large responses (eg. contract lists) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# time every statement, and tag slow ones with the route that ran them
+slow_queries.install(database.engine)
+app.add_middleware(slow_queries.SlowQueryMiddleware)
+
+# opt-in request profiling (PROFILE_SAMPLE_RATE / PROFILE_ROUTES / X-Profile), outermost so it sees the whole request
+app.add_middleware(ProfilerMiddleware)
+
+for name in mounted_routers:
+    module, prefix = ROUTERS[name]
+    app.include_router(load(f"{module}:router"), prefix=prefix)
 
 @app.get("/")
 def read_root():
-    return {"message": "Hello, World!"}
\ No newline at end of file
+    return {"message": "Hello, World!"}
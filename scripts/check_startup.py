@@ -0,0 +1,82 @@
+'''
+Startup time regression check.
+
+Imports main.py in a fresh interpreter with `python -X importtime`, reports the
+cost of each import, and fails if startup goes over budget or if a profile pulls
+in modules it should not (eg. the ingest profile importing the ledger or crypto stacks).
+
+Usage:
+    python scripts/check_startup.py [--profile ingest] [--budget-ms 2500] [--top 25]
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must stay out of a profile's startup
+FORBIDDEN_MODULES = {
+    "ingest": ["xrpl", "cryptoconditions", "passlib", "bcrypt", "jose", "pytz"],
+    "full": ["xrpl", "cryptoconditions", "passlib", "bcrypt", "jose", "pytz"],
+}
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(profile: str):
+    '''
+    Returns ([(cumulative us, self us, module)], modules loaded) for importing main.
+    '''
+    env = dict(os.environ, APP_PROFILE=profile)
+    env.pop("APP_ROUTERS", None)
+    proc = subprocess.run(
+        [
+            sys.executable, "-X", "importtime", "-c",
+            "import sys, main; print('\\n'.join(sorted(sys.modules)))",
+        ],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        sys.exit(f"importing main failed:\n{proc.stderr}")
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return imports, set(proc.stdout.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", default="ingest")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "2500")))
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    imports, modules = measure(args.profile)
+
+    # top level imports only, nested ones are already part of their parent's cumulative time
+    top_level = [entry for entry in imports if not entry[2].startswith("  ")]
+    total_ms = sum(cumulative for cumulative, _, _ in top_level) / 1000
+
+    print(f"profile: {args.profile}")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_us, module in sorted(imports, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {module}")
+    print(f"total import time: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f"startup imports took {total_ms:.1f} ms, over the {args.budget_ms:.0f} ms budget")
+    for forbidden in FORBIDDEN_MODULES.get(args.profile, []):
+        if forbidden in modules:
+            failures.append(f"{forbidden} is imported at startup")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
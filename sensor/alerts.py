@@ -0,0 +1,200 @@
+'''
+Real-time threshold alerting on sensor ingest.
+
+Each contract gets a compiled rule set: a sorted tuple of thresholds per counter
+(the same drop tiers complete_contract pays out on, plus overtemp and water rules).
+Ingest evaluates a reading by bisecting the old and new counter totals against
+those thresholds, so the cost is a couple of comparisons and no I/O.
+
+Alerts are published with pg_notify in the ingest transaction, so they only go out
+if the reading is committed, and reach subscribers on every worker. Each worker
+listens on the channel and fans alerts out to its own subscribers' queues.
+'''
+import asyncio
+import json
+import os
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, timezone
+from sqlalchemy import text
+
+from database import database
+from contracts import settlement
+
+ALERT_CHANNEL = "contract_alerts"
+
+# Overtemp / water event counts that raise an alert when a contract's total crosses them
+ALERT_OVERTEMP_THRESHOLDS = tuple(
+    int(threshold) for threshold in os.getenv("ALERT_OVERTEMP_THRESHOLDS", "1,5,10").split(",")
+)
+ALERT_WATER_THRESHOLDS = tuple(
+    int(threshold) for threshold in os.getenv("ALERT_WATER_THRESHOLDS", "1,3").split(",")
+)
+
+# compiled rule sets kept around, by contract id
+ALERT_RULE_CACHE_SIZE = int(os.getenv("ALERT_RULE_CACHE_SIZE", "10000"))
+# alerts buffered per subscriber before the oldest ones are dropped
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "100"))
+
+DROP_TIER_MESSAGES = {
+    "t2": "Tier 2 bonus lost",
+    "t1": "Tier 1 bonus lost",
+    "base": "Base payment lost, collateral forfeited",
+}
+
+
+class CompiledRules:
+    '''
+    Thresholds per counter, sorted, with the message for crossing each one.
+    '''
+    __slots__ = ("thresholds", "messages")
+
+    def __init__(self, rules: dict):
+        # rules: {counter: [(threshold, message)]}, an alert fires once the total goes above threshold
+        self.thresholds = {}
+        self.messages = {}
+        for counter, counter_rules in rules.items():
+            counter_rules = sorted(counter_rules)
+            self.thresholds[counter] = tuple(threshold for threshold, _ in counter_rules)
+            self.messages[counter] = tuple(message for _, message in counter_rules)
+
+    def evaluate(self, old: dict, new: dict) -> list:
+        '''
+        Returns [(counter, threshold, message)] for every threshold the counters crossed
+        going from the old totals to the new ones.
+        '''
+        crossed = []
+        for counter, thresholds in self.thresholds.items():
+            start = bisect_left(thresholds, old[counter])
+            end = bisect_left(thresholds, new[counter])
+            for idx in range(start, end):
+                crossed.append((counter, thresholds[idx], self.messages[counter][idx]))
+        return crossed
+
+
+_rule_cache = OrderedDict()
+
+
+def compile_rules(contract) -> CompiledRules:
+    '''
+    Compiles (or fetches) the rules for a contract.
+    Drop tiers for legs that are worth nothing on this contract are left out.
+    '''
+    rules = _rule_cache.get(contract.contract_id)
+    if rules is not None:
+        _rule_cache.move_to_end(contract.contract_id)
+        return rules
+
+    leg_values = {"base": contract.base_price, "t1": contract.t1_bonus, "t2": contract.t2_bonus}
+    drop_rules = [
+        (settlement.DROP_TIERS[leg], DROP_TIER_MESSAGES[leg])
+        for leg in settlement.PAYMENT_LEGS if leg_values[leg]
+    ]
+    rules = CompiledRules({
+        "drop_alerts": drop_rules,
+        # thresholds are "at least n events", ie. above n - 1
+        "overtemp_alerts": [
+            (threshold - 1, f"Overtemperature events reached {threshold}") for threshold in ALERT_OVERTEMP_THRESHOLDS
+        ],
+        "water_events": [
+            (threshold - 1, f"Water exposure events reached {threshold}") for threshold in ALERT_WATER_THRESHOLDS
+        ],
+    })
+
+    _rule_cache[contract.contract_id] = rules
+    if len(_rule_cache) > ALERT_RULE_CACHE_SIZE:
+        _rule_cache.popitem(last=False)
+    return rules
+
+
+def evaluate_batch(readings: list) -> list:
+    '''
+    Evaluates a batch of readings, each (contract, old totals, new totals).
+    Returns the alerts to publish.
+    '''
+    alerts = []
+    now = datetime.now(timezone.utc).isoformat()
+    for contract, old, new in readings:
+        for counter, threshold, message in compile_rules(contract).evaluate(old, new):
+            alerts.append({
+                "contract_id": contract.contract_id,
+                "sensor_id": contract.sensor_id,
+                "proposer_id": contract.proposer_id,
+                "courier_id": contract.courier_id,
+                "counter": counter,
+                "threshold": threshold,
+                "value": new[counter],
+                "message": message,
+                "time": now,
+            })
+    return alerts
+
+
+async def publish(session, alerts: list):
+    '''
+    Queues alerts for delivery when the session's transaction commits.
+    '''
+    for alert in alerts:
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": ALERT_CHANNEL, "payload": json.dumps(alert)}
+        )
+
+
+class AlertHub:
+    '''
+    In-process fan out of alerts to subscriber queues, by user.
+    '''
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, user: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self.subscribers.setdefault(user, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user]
+
+    def dispatch(self, alert: dict):
+        for user in {alert["proposer_id"], alert["courier_id"]}:
+            for queue in self.subscribers.get(user, ()):
+                if queue.full():
+                    # slow subscriber, drop its oldest alert rather than block ingest
+                    queue.get_nowait()
+                queue.put_nowait(alert)
+
+
+hub = AlertHub()
+
+
+def _on_notification(connection, pid, channel, payload):
+    hub.dispatch(json.loads(payload))
+
+
+async def listen_for_alerts():
+    '''
+    Listens for alerts from every worker and hands them to this worker's subscribers.
+    Reconnects if the listening connection drops.
+    '''
+    while True:
+        try:
+            async with database.engine.connect() as conn:
+                raw_connection = await conn.get_raw_connection()
+                listener = raw_connection.driver_connection
+                await listener.add_listener(ALERT_CHANNEL, _on_notification)
+                try:
+                    while not listener.is_closed():
+                        await asyncio.sleep(5)
+                finally:
+                    if not listener.is_closed():
+                        await listener.remove_listener(ALERT_CHANNEL, _on_notification)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Alert listener failed: {e}")
+        await asyncio.sleep(5)
@@ -0,0 +1,86 @@
+'''
+Duplicate reading suppression for sensors that send a sequence number.
+
+Each sensor has a sliding window: the highest sequence number accepted, plus a
+63 bit bitmap of which of the 63 numbers below it were accepted too (it fits a
+signed BIGINT column). The window is persisted on the sensor_data row, and each
+worker caches the windows it has seen in slot arrays, allocated on the first
+window stored (SEQ_CACHE_CAPACITY sensors). A hit in the cache is
+always a real duplicate, so those are dropped without touching the database;
+anything else is checked against the persisted window under a row lock.
+'''
+import os
+from array import array
+
+SEQ_WINDOW_BITS = 63
+SEQ_WINDOW_MASK = (1 << SEQ_WINDOW_BITS) - 1
+# a sequence number this far behind the window means the device restarted its counter
+SEQ_RESET_GAP = int(os.getenv("SEQ_RESET_GAP", "1000"))
+# sensors whose windows are cached per worker
+SEQ_CACHE_CAPACITY = int(os.getenv("SEQ_CACHE_CAPACITY", str(1 << 20)))
+
+
+def advance(high: int, window: int, seq: int):
+    '''
+    Checks seq against a window (high = None for a sensor with no readings yet).
+    Returns (is_new, high, window) with the window updated to include seq.
+    '''
+    if high is None:
+        return True, seq, 1
+    if seq > high:
+        shift = seq - high
+        window = ((window << shift) | 1) & SEQ_WINDOW_MASK if shift < SEQ_WINDOW_BITS else 1
+        return True, seq, window
+    offset = high - seq
+    if offset >= SEQ_WINDOW_BITS:
+        if offset > SEQ_RESET_GAP:
+            return True, seq, 1
+        return False, high, window
+    bit = 1 << offset
+    if window & bit:
+        return False, high, window
+    return True, high, window | bit
+
+
+class SequenceWindows:
+    '''
+    Per-worker cache of sensor windows, in slot arrays.
+    When full, slots are reused round robin; losing a window only means the
+    next reading from that sensor is checked against the database.
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.slots = {}
+        # allocated on first use
+        self.keys = None
+        self.highs = None
+        self.windows = None
+        self.hand = 0
+
+    def is_duplicate(self, sensor_id: str, seq: int) -> bool:
+        slot = self.slots.get(sensor_id)
+        if slot is None:
+            return False
+        # only trust bitmap hits, anything older is for the database to judge
+        offset = self.highs[slot] - seq
+        return 0 <= offset < SEQ_WINDOW_BITS and bool(self.windows[slot] & (1 << offset))
+
+    def store(self, sensor_id: str, high: int, window: int):
+        slot = self.slots.get(sensor_id)
+        if slot is None:
+            if self.keys is None:
+                self.keys = [None] * self.capacity
+                self.highs = array("q", bytes(8 * self.capacity))
+                self.windows = array("q", bytes(8 * self.capacity))
+            slot = self.hand
+            self.hand = (self.hand + 1) % self.capacity
+            evicted = self.keys[slot]
+            if evicted is not None:
+                del self.slots[evicted]
+            self.keys[slot] = sensor_id
+            self.slots[sensor_id] = slot
+        self.highs[slot] = high
+        self.windows[slot] = window
+
+
+windows = SequenceWindows(SEQ_CACHE_CAPACITY)
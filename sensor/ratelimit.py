@@ -0,0 +1,127 @@
+'''
+Admission control for sensor ingestion.
+
+Token buckets per sensor uid and per source IP reject floods before they reach
+postgres, and a global concurrency cap sheds load when too much database-bound
+work is already in flight.
+
+Bucket state lives in fixed-size slot arrays (two doubles per key) indexed
+through a dict, so millions of devices fit in a few tens of MB. The arrays are
+sized by RATE_LIMIT_CAPACITY and only allocated on the first request a limiter
+sees, so workers that never ingest don't pay for them. When the arrays are full,
+slots are reused round robin, which at worst hands an evicted key a fresh bucket.
+'''
+import asyncio
+import math
+import os
+import time
+from array import array
+from contextlib import asynccontextmanager
+from fastapi.exceptions import HTTPException
+
+SENSOR_RATE_PER_SECOND = float(os.getenv("SENSOR_RATE_PER_SECOND", "1"))
+SENSOR_BURST = float(os.getenv("SENSOR_BURST", "10"))
+IP_RATE_PER_SECOND = float(os.getenv("IP_RATE_PER_SECOND", "50"))
+IP_BURST = float(os.getenv("IP_BURST", "200"))
+# keys tracked per limiter
+RATE_LIMIT_CAPACITY = int(os.getenv("RATE_LIMIT_CAPACITY", str(1 << 20)))
+# database-bound ingest requests allowed in flight per worker, and how long a request may queue for one
+INGEST_MAX_CONCURRENCY = int(os.getenv("INGEST_MAX_CONCURRENCY", "50"))
+INGEST_QUEUE_TIMEOUT_SECONDS = float(os.getenv("INGEST_QUEUE_TIMEOUT_SECONDS", "0.5"))
+
+
+class TokenBucketLimiter:
+    '''
+    Token buckets for many keys, in slot arrays.
+    '''
+    def __init__(self, rate: float, burst: float, capacity: int):
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        self.slots = {}
+        # allocated on first use
+        self.keys = None
+        self.tokens = None
+        self.updated = None
+        self.hand = 0
+
+    def _allocate(self, key, now: float) -> int:
+        if self.keys is None:
+            self.keys = [None] * self.capacity
+            self.tokens = array("d", bytes(8 * self.capacity))
+            self.updated = array("d", bytes(8 * self.capacity))
+        slot = self.hand
+        self.hand = (self.hand + 1) % self.capacity
+        evicted = self.keys[slot]
+        if evicted is not None:
+            del self.slots[evicted]
+        self.keys[slot] = key
+        self.slots[key] = slot
+        self.tokens[slot] = self.burst
+        self.updated[slot] = now
+        return slot
+
+    def acquire(self, key, now: float = None) -> float:
+        '''
+        Takes a token for key.
+        Returns 0 if it was allowed, otherwise the seconds until a token is available.
+        '''
+        now = time.monotonic() if now is None else now
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._allocate(key, now)
+
+        tokens = min(self.burst, self.tokens[slot] + (now - self.updated[slot]) * self.rate)
+        self.updated[slot] = now
+        if tokens >= 1:
+            self.tokens[slot] = tokens - 1
+            return 0
+        self.tokens[slot] = tokens
+        return (1 - tokens) / self.rate
+
+
+sensor_limiter = TokenBucketLimiter(SENSOR_RATE_PER_SECOND, SENSOR_BURST, RATE_LIMIT_CAPACITY)
+ip_limiter = TokenBucketLimiter(IP_RATE_PER_SECOND, IP_BURST, RATE_LIMIT_CAPACITY)
+ingest_slots = asyncio.Semaphore(INGEST_MAX_CONCURRENCY)
+
+
+def _throttled(retry_after: float, detail: str):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+def check_rate(sensor_uid, source_ip: str):
+    '''
+    Raises 429 with Retry-After if the source IP or the sensor is over its rate.
+    '''
+    now = time.monotonic()
+    if source_ip:
+        retry_after = ip_limiter.acquire(source_ip, now)
+        if retry_after:
+            raise _throttled(retry_after, "Too many requests from this address")
+    retry_after = sensor_limiter.acquire(sensor_uid, now)
+    if retry_after:
+        raise _throttled(retry_after, "Too many readings from this sensor")
+
+
+@asynccontextmanager
+async def admission():
+    '''
+    Holds one of the worker's database-bound ingest slots.
+    Sheds the request with 503 if none frees up within INGEST_QUEUE_TIMEOUT_SECONDS.
+    '''
+    try:
+        await asyncio.wait_for(ingest_slots.acquire(), INGEST_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Ingest is overloaded, please retry",
+            headers={"Retry-After": "1"}
+        )
+    try:
+        yield
+    finally:
+        ingest_slots.release()
@@ -0,0 +1,99 @@
+'''
+Background job that purges sensor_data rows of inactive sensors.
+
+A sensor whose last reading is older than SENSOR_DATA_RETENTION_DAYS, and that is
+not tracking a contract, has its row deleted. If it reports again it starts
+over like a new sensor, with a new row and a fresh sequence window.
+
+Rows are deleted SENSOR_PURGE_BATCH_SIZE at a time, one short transaction each.
+Rows that ingest has locked are skipped, and lock waits are capped at
+SENSOR_PURGE_LOCK_TIMEOUT_MS.
+Only one worker runs a pass at a time, through a postgres advisory lock.
+'''
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, exists, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.future import select
+
+from database import database
+
+SENSOR_PURGE_INTERVAL_SECONDS = int(os.getenv("SENSOR_PURGE_INTERVAL_SECONDS", "3600"))
+# sensors quiet for this long lose their row
+SENSOR_DATA_RETENTION_DAYS = float(os.getenv("SENSOR_DATA_RETENTION_DAYS", "30"))
+# rows deleted per transaction, and batches per pass
+SENSOR_PURGE_BATCH_SIZE = int(os.getenv("SENSOR_PURGE_BATCH_SIZE", "500"))
+SENSOR_PURGE_MAX_BATCHES = int(os.getenv("SENSOR_PURGE_MAX_BATCHES", "50"))
+# pause between batches, so ingest gets the table in between
+SENSOR_PURGE_BATCH_PAUSE_SECONDS = float(os.getenv("SENSOR_PURGE_BATCH_PAUSE_SECONDS", "0.2"))
+SENSOR_PURGE_LOCK_TIMEOUT_MS = int(os.getenv("SENSOR_PURGE_LOCK_TIMEOUT_MS", "500"))
+
+SENSOR_PURGE_LOCK_NAME = "sensor.retention"
+
+
+async def purge_batch(cutoff: datetime) -> int:
+    '''
+    Deletes one batch of inactive sensor rows.
+    Returns the number of rows deleted.
+    '''
+    tracking_contract = exists().where(
+        database.Contract.sensor_id == database.SensorData.sensor_id,
+        database.Contract.contract_status.in_([
+            database.ContractStatus.FULFILLMENT.value,
+            database.ContractStatus.SETTLING.value,
+        ]),
+    )
+    inactive = (
+        select(database.SensorData.sensor_id)
+        .where(database.SensorData.updated_at < cutoff, ~tracking_contract)
+        .limit(SENSOR_PURGE_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    async with database.AsyncSessionLocalFactory() as session:
+        await session.execute(text(f"SET LOCAL lock_timeout = {SENSOR_PURGE_LOCK_TIMEOUT_MS}"))
+        purged = await session.execute(
+            delete(database.SensorData)
+            .where(database.SensorData.sensor_id.in_(inactive.scalar_subquery()))
+            .returning(database.SensorData.sensor_id)
+            .execution_options(synchronize_session=False)
+        )
+        purged = len(purged.all())
+        await session.commit()
+    return purged
+
+
+async def purge_inactive_sensor_data():
+    '''
+    Runs one purge pass, unless another worker is already running one.
+    '''
+    async with database.advisory_lock(SENSOR_PURGE_LOCK_NAME) as acquired:
+        if not acquired:
+            return
+        cutoff = datetime.now(timezone.utc) - timedelta(days=SENSOR_DATA_RETENTION_DAYS)
+        purged = 0
+        for _ in range(SENSOR_PURGE_MAX_BATCHES):
+            try:
+                deleted = await purge_batch(cutoff)
+            except DBAPIError as e:
+                # most likely the lock timeout, the rest waits for the next pass
+                print(f"Sensor data purge batch gave way: {e}")
+                break
+            purged += deleted
+            if deleted < SENSOR_PURGE_BATCH_SIZE:
+                break
+            await asyncio.sleep(SENSOR_PURGE_BATCH_PAUSE_SECONDS)
+        if purged:
+            print(f"Sensor data purge: deleted {purged} inactive sensor rows")
+
+
+async def run_sensor_data_purge():
+    '''
+    Runs the sensor data purge forever, every SENSOR_PURGE_INTERVAL_SECONDS.
+    '''
+    while True:
+        try:
+            await purge_inactive_sensor_data()
+        except Exception as e:
+            print(f"Sensor data purge failed: {e}")
+        await asyncio.sleep(SENSOR_PURGE_INTERVAL_SECONDS)
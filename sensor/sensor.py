@@ -1,19 +1,35 @@
 from fastapi import APIRouter, Response, Request, Depends
+from fastapi.responses import StreamingResponse
+import asyncio
+import csv
+import io
+import json
 from database import database
 from sqlalchemy.future import select
 from sqlalchemy import DateTime
+from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime
 from datetime import timezone
 from fastapi.exceptions import HTTPException
 from sqlalchemy.exc import IntegrityError
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
+from typing import Optional
 from starlette import status
 
 from auth import auth
 from database import database
+from sensor import alerts
+from sensor import ratelimit
+from sensor import dedupe
+from sensor import tracking
 
 router = APIRouter()
 
+# SSE keepalive, so proxies don't close idle alert streams
+ALERT_KEEPALIVE_SECONDS = 15
+# two bind parameters per sensor, asyncpg allows 32767 per statement
+SENSOR_BULK_MAX_ROWS = 10000
+
 @router.post("/register_sensor", tags=["Sensor"])
 async def register_sensor(
     sensor: str, 
@@ -33,6 +49,82 @@ async def register_sensor(
     return {'registered_sensor_id': sensor, 'registered_owner': _user['sub']}
 
 
+async def read_sensor_ids(request: Request) -> list:
+    '''
+    Reads sensor IDs from a JSON list, or a CSV (Content-Type: text/csv) with one ID per row
+    and an optional sensor_id header. Duplicates are dropped, order is kept.
+    '''
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("text/csv"):
+            rows = [row for row in csv.reader(io.StringIO(body.decode("utf-8"))) if row]
+            if rows and rows[0][0].strip() == "sensor_id":
+                rows = rows[1:]
+            sensor_ids = [row[0] for row in rows]
+        else:
+            sensor_ids = json.loads(body)
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse body: {str(e)}")
+
+    if not isinstance(sensor_ids, list) or not all(isinstance(sensor_id, (str, int)) for sensor_id in sensor_ids):
+        raise HTTPException(status_code=400, detail="Body must be a list of sensor IDs")
+    sensor_ids = [str(sensor_id).strip() for sensor_id in sensor_ids]
+    if not all(sensor_ids):
+        raise HTTPException(status_code=400, detail="Sensor IDs can't be empty")
+    if len(sensor_ids) > SENSOR_BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {SENSOR_BULK_MAX_ROWS} sensors per request")
+    return list(dict.fromkeys(sensor_ids))
+
+
+@router.post("/register_sensors", tags=["Sensor"])
+async def register_sensors(
+    request: Request,
+    _user: None = Depends(auth.get_current_user),
+    _auth: None = Depends(auth.check_and_renew_access_token)
+):
+    '''
+    Registers a fleet of sensors in one go.
+    Body is a JSON list of sensor IDs, or a CSV (Content-Type: text/csv) with one ID per row.
+    Reports for each ID whether it was registered now, was already yours, or belongs to someone else.
+    '''
+    user = _user['sub']
+    sensor_ids = await read_sensor_ids(request)
+    if not sensor_ids:
+        return {"registered": 0, "results": []}
+
+    async with database.AsyncSessionLocalFactory() as session:
+        registered = await session.execute(
+            insert(database.Sensor)
+            .values([{"sensor_id": sensor_id, "owner_id": user} for sensor_id in sensor_ids])
+            .on_conflict_do_nothing(index_elements=["sensor_id"])
+            .returning(database.Sensor.sensor_id)
+        )
+        registered = set(registered.scalars().all())
+
+        # whoever already had the rest
+        taken = [sensor_id for sensor_id in sensor_ids if sensor_id not in registered]
+        owners = {}
+        if taken:
+            owners = await session.execute(
+                select(database.Sensor.sensor_id, database.Sensor.owner_id).where(
+                    database.Sensor.sensor_id.in_(taken)
+                )
+            )
+            owners = dict(owners.all())
+        await session.commit()
+
+    results = []
+    for sensor_id in sensor_ids:
+        if sensor_id in registered:
+            result = "registered"
+        elif owners.get(sensor_id) == user:
+            result = "already_owned"
+        else:
+            result = "owned_by_other"
+        results.append({"sensor_id": sensor_id, "status": result})
+    return {"registered": len(registered), "results": results}
+
+
 # Define a Pydantic model matching the sensor's POST payload.
 class SensorPayload(BaseModel):
     uid: int       # sensor identifier (will be converted to string)
@@ -41,12 +133,20 @@ class SensorPayload(BaseModel):
     fall: int      # fall (drop) events
     temp: int      # temperature events
     hum: int       # water/humidity events
+    seq: Optional[conint(ge=0, lt=2**63)] = None  # per-device sequence number, retransmissions reuse it (fits a BIGINT)
 
 @router.post("/sensor_data", tags=["Sensor"])
-async def sensor_data(payload: SensorPayload):
+async def sensor_data(payload: SensorPayload, request: Request):
     sensor_id_str = str(payload.uid)
-    
-    async with database.AsyncSessionLocalFactory() as session:
+
+    # reject floods before they cost a database round trip
+    ratelimit.check_rate(payload.uid, request.client.host if request.client else None)
+
+    # retransmission of a reading this worker already stored
+    if payload.seq is not None and dedupe.windows.is_duplicate(sensor_id_str, payload.seq):
+        return {"status": "duplicate", "sensor_id": sensor_id_str}
+
+    async with ratelimit.admission(), database.AsyncSessionLocalFactory() as session:
         # Check if the sensor is registered in user_sensors.
         result = await session.execute(
             select(database.Sensor).filter_by(sensor_id=sensor_id_str)
@@ -58,12 +158,20 @@ async def sensor_data(payload: SensorPayload):
         
         # Check if the sensor is associated with an open contract.
         result = await session.execute(
-            select(database.Contract).where(
-                database.Sensor.sensor_id == sensor_id_str and
-                database.Contract.contract_status == database.ContractStatus.FULFILLMENT 
+            select(
+                database.Contract.contract_id,
+                database.Contract.sensor_id,
+                database.Contract.proposer_id,
+                database.Contract.courier_id,
+                database.Contract.base_price,
+                database.Contract.t1_bonus,
+                database.Contract.t2_bonus,
+            ).where(
+                database.Contract.sensor_id == sensor_id_str,
+                database.Contract.contract_status == database.ContractStatus.FULFILLMENT.value
             )
         )
-        in_progress_contract = result.scalars().all()
+        in_progress_contract = result.first()
         if not in_progress_contract:
             raise HTTPException(
                 status_code=status.HTTP_412_PRECONDITION_FAILED,
@@ -71,18 +179,40 @@ async def sensor_data(payload: SensorPayload):
             )
 
         # Next, try to retrieve an existing sensor_data record.
+        # Locked, so concurrent readings from the same sensor check its sequence window in turn.
         result = await session.execute(
-            select(database.SensorData).filter_by(sensor_id=sensor_id_str)
+            select(database.SensorData).filter_by(sensor_id=sensor_id_str).with_for_update()
         )
         sensor_data_record = result.scalar_one_or_none()
 
+        seq_window = None
+        if payload.seq is not None:
+            is_new, last_seq, seq_window = dedupe.advance(
+                sensor_data_record.last_seq if sensor_data_record else None,
+                sensor_data_record.seq_window if sensor_data_record else 0,
+                payload.seq
+            )
+            if not is_new:
+                await session.rollback()
+                dedupe.windows.store(sensor_id_str, last_seq, seq_window)
+                return {"status": "duplicate", "sensor_id": sensor_id_str}
+
+        old_totals = {"drop_alerts": 0, "overtemp_alerts": 0, "water_events": 0}
         if sensor_data_record:
+            old_totals = {
+                "drop_alerts": sensor_data_record.drop_alerts,
+                "overtemp_alerts": sensor_data_record.overtemp_alerts,
+                "water_events": sensor_data_record.water_events,
+            }
             # Sensor data exists: update its counters and location.
             sensor_data_record.drop_alerts += payload.fall
             sensor_data_record.overtemp_alerts += payload.temp
             sensor_data_record.water_events += payload.hum
             sensor_data_record.longitude = payload.long
             sensor_data_record.latitude = payload.lat
+            if seq_window is not None:
+                sensor_data_record.last_seq = last_seq
+                sensor_data_record.seq_window = seq_window
         else:
             # Sensor data does not exist; create a new record.
             new_sensor_data = database.SensorData(
@@ -92,13 +222,102 @@ async def sensor_data(payload: SensorPayload):
                 water_events=payload.hum,
                 longitude=payload.long,
                 latitude=payload.lat,
+                last_seq=last_seq if seq_window is not None else None,
+                seq_window=seq_window,
             )
             session.add(new_sensor_data)
 
+        new_totals = {
+            counter: old_totals[counter] + delta
+            for counter, delta in (
+                ("drop_alerts", payload.fall),
+                ("overtemp_alerts", payload.temp),
+                ("water_events", payload.hum),
+            )
+        }
+
         try:
+            # threshold alerts go out with the commit
+            await alerts.publish(
+                session,
+                alerts.evaluate_batch([(in_progress_contract, old_totals, new_totals)])
+            )
             await session.commit()
         except Exception as e:
             await session.rollback()
             raise HTTPException(status_code=400, detail=f"Error updating sensor data: {str(e)}")
+
+    if seq_window is not None:
+        dedupe.windows.store(sensor_id_str, last_seq, seq_window)
+
+    tracking.store.record(
+        in_progress_contract.contract_id,
+        sensor_id_str,
+        in_progress_contract.proposer_id,
+        in_progress_contract.courier_id,
+        payload.long,
+        payload.lat
+    )
         
     return {"status": "success", "sensor_id": sensor_id_str}
+
+
+@router.get("/alerts", tags=["Sensor"])
+async def sensor_alerts(
+    request: Request,
+    _user: None = Depends(auth.get_current_user),
+    _auth: None = Depends(auth.check_and_renew_access_token)
+):
+    '''
+    Streams threshold alerts (drop tiers, overtemperature, water exposure)
+    for contracts the user proposed or is delivering, as server-sent events.
+    '''
+    user = _user['sub']
+    queue = alerts.hub.subscribe(user)
+
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    alert = await asyncio.wait_for(queue.get(), ALERT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: alert\ndata: {json.dumps(alert)}\n\n"
+        finally:
+            alerts.hub.unsubscribe(user, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@router.get("/track/{contract_id}", tags=["Sensor"])
+async def track_contract(
+    contract_id: int,
+    response: Response,
+    limit: int = tracking.TRACK_HISTORY_SIZE,
+    _user: None = Depends(auth.get_current_user),
+    _auth: None = Depends(auth.check_and_renew_access_token)
+):
+    '''
+    Returns the current position and recent path (newest first) of a contract in fulfillment.
+    Only the proposer and the courier can track it. Served from memory, never from the database.
+    '''
+    tracked = tracking.store.track(contract_id, max(1, limit))
+    if tracked is None or _user['sub'] not in tracked[1]:
+        response.status_code = 404
+        return {"detail": "No live position for this contract"}
+
+    sensor_id, _, path = tracked
+    path = [
+        {
+            "longitude": longitude,
+            "latitude": latitude,
+            "time": datetime.fromtimestamp(recorded, timezone.utc).isoformat(),
+        } for longitude, latitude, recorded in path
+    ]
+    return {
+        "contract_id": contract_id,
+        "sensor_id": sensor_id,
+        "position": path[0],
+        "path": path,
+    }
@@ -0,0 +1,117 @@
+'''
+In-memory live location store for shipment tracking.
+
+Ingest records each accepted reading's position here, so a contract's current
+position and recent path are served without touching postgres. Every tracked
+contract gets a slot with a fixed-size ring buffer of positions, stored in flat
+arrays, so memory per device is bounded by TRACK_HISTORY_SIZE. The arrays are
+allocated on the first position recorded, so workers that only evict (eg. the
+contracts routes) never pay for them. Slots are freed when the contract
+completes or fails, or when the device has gone quiet for TRACK_TTL_SECONDS;
+when every slot is taken, the oldest one is reused round robin.
+
+Positions live in the process that ingested them, so tracking reads should go to
+the same process as the sensor traffic (eg. the ingest profile).
+'''
+import os
+import time
+from array import array
+
+# positions kept per device
+TRACK_HISTORY_SIZE = int(os.getenv("TRACK_HISTORY_SIZE", "64"))
+# devices tracked per worker
+TRACK_CAPACITY = int(os.getenv("TRACK_CAPACITY", str(1 << 14)))
+# devices that have not reported for this long are dropped
+TRACK_TTL_SECONDS = float(os.getenv("TRACK_TTL_SECONDS", "3600"))
+
+
+class LocationStore:
+    '''
+    Ring buffers of recent positions per contract, in slot arrays.
+    '''
+    def __init__(self, capacity: int, history: int):
+        self.capacity = capacity
+        self.history = history
+        self.slots = {}
+        # the arrays are allocated on first use
+        self.contracts = None
+        self.hand = 0
+
+    def _allocate_arrays(self):
+        capacity = self.capacity
+        self.contracts = [None] * capacity
+        self.sensors = [None] * capacity
+        # (proposer, courier), the only users who may see the position
+        self.participants = [None] * capacity
+        self.longitudes = array("d", bytes(8 * capacity * self.history))
+        self.latitudes = array("d", bytes(8 * capacity * self.history))
+        self.times = array("d", bytes(8 * capacity * self.history))
+        # next position to write, and positions stored, per slot
+        self.heads = array("l", bytes(array("l").itemsize * capacity))
+        self.counts = array("l", bytes(array("l").itemsize * capacity))
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def _allocate(self, contract_id: int) -> int:
+        if self.contracts is None:
+            self._allocate_arrays()
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = self.hand
+            self.hand = (self.hand + 1) % self.capacity
+            del self.slots[self.contracts[slot]]
+        self.contracts[slot] = contract_id
+        self.slots[contract_id] = slot
+        self.heads[slot] = 0
+        self.counts[slot] = 0
+        return slot
+
+    def record(self, contract_id: int, sensor_id: str, proposer_id: str, courier_id: str,
+               longitude: float, latitude: float, now: float = None):
+        slot = self.slots.get(contract_id)
+        if slot is None:
+            slot = self._allocate(contract_id)
+        self.sensors[slot] = sensor_id
+        self.participants[slot] = (proposer_id, courier_id)
+
+        idx = slot * self.history + self.heads[slot]
+        self.longitudes[idx] = longitude
+        self.latitudes[idx] = latitude
+        self.times[idx] = time.time() if now is None else now
+        self.heads[slot] = (self.heads[slot] + 1) % self.history
+        if self.counts[slot] < self.history:
+            self.counts[slot] += 1
+
+    def evict(self, contract_id: int):
+        slot = self.slots.pop(contract_id, None)
+        if slot is None:
+            return
+        self.contracts[slot] = None
+        self.sensors[slot] = None
+        self.participants[slot] = None
+        self.free.append(slot)
+
+    def track(self, contract_id: int, limit: int = None, now: float = None):
+        '''
+        Returns (sensor_id, (proposer_id, courier_id), [(longitude, latitude, time)] newest first),
+        or None if the contract is not being tracked.
+        '''
+        slot = self.slots.get(contract_id)
+        if slot is None:
+            return None
+        count = self.counts[slot]
+        base = slot * self.history
+        newest = (self.heads[slot] - 1) % self.history
+        now = time.time() if now is None else now
+        if now - self.times[base + newest] > TRACK_TTL_SECONDS:
+            self.evict(contract_id)
+            return None
+
+        path = []
+        for offset in range(min(count, limit or count)):
+            idx = base + (newest - offset) % self.history
+            path.append((self.longitudes[idx], self.latitudes[idx], self.times[idx]))
+        return self.sensors[slot], self.participants[slot], path
+
+
+store = LocationStore(TRACK_CAPACITY, TRACK_HISTORY_SIZE)
@@ -1,18 +1,163 @@
-from xrpl.clients import JsonRpcClient
-from xrpl.asyncio.wallet import generate_faucet_wallet as async_generate_faucet_wallet
-from xrpl.models import EscrowFinish
-from xrpl.wallet import Wallet
-from xrpl.constants import CryptoAlgorithm
-from xrpl.models import EscrowCreate
+'''
+XRP ledger helpers.
+xrpl and cryptoconditions are heavy to import, so they are imported inside the
+functions that use them. Importing this module stays cheap for workers that
+never touch the ledger.
+Transactions wait for validation through the shared subscription in xrpledger.subscriptions.
+'''
+from dataclasses import replace
 from datetime import datetime, timedelta
-from xrpl.utils import datetime_to_ripple_time, xrp_to_drops
 from os import urandom
-from cryptoconditions import PreimageSha256
-from xrpl.models import EscrowCancel
-from xrpl.asyncio.transaction import submit_and_wait as async_submit_and_wait
-from xrpl.asyncio.account import get_balance as async_get_balance
+import asyncio
+import functools
+import os
+import time
 
+# Deadlines for a single call to the ledger, so a slow testnet fails fast
+XRPL_CALL_TIMEOUT_SECONDS = float(os.getenv("XRPL_CALL_TIMEOUT_SECONDS", "30"))
+XRPL_FAUCET_TIMEOUT_SECONDS = float(os.getenv("XRPL_FAUCET_TIMEOUT_SECONDS", "60"))
+# Consecutive transport failures before the circuit opens, and how long it stays open
+XRPL_BREAKER_FAILURE_THRESHOLD = int(os.getenv("XRPL_BREAKER_FAILURE_THRESHOLD", "5"))
+XRPL_BREAKER_RESET_SECONDS = float(os.getenv("XRPL_BREAKER_RESET_SECONDS", "30"))
+# Objects / transactions per page when reading account state back from the ledger
+XRPL_PAGE_SIZE = int(os.getenv("XRPL_PAGE_SIZE", "200"))
+
+
+class LedgerUnavailable(Exception):
+    '''
+    Raised when the ledger did not answer in time, or the circuit breaker is open.
+    '''
+
+
+class EscrowCreateFailed(Exception):
+    '''
+    Raised by create_escrow when a submission fails part way through.
+    created holds [sequences, conditions, fulfillments] of the escrows that did
+    make it onto the ledger, so the caller can record them and get them cancelled.
+    The escrow whose submission failed is not in it; if it went through after
+    all, the reconciler reports it as an orphan.
+    '''
+    def __init__(self, cause: Exception, created: list):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.created = created
+
+
+class CircuitBreaker:
+    '''
+    Opens after too many consecutive transport failures, failing every call
+    straight away until the reset timeout passes. Then one trial call goes
+    through, and closes the circuit again if it succeeds.
+    '''
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            raise LedgerUnavailable("XRPL circuit breaker is open")
+        # half open, let this call through as a trial
+        self.opened_at = time.monotonic()
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(XRPL_BREAKER_FAILURE_THRESHOLD, XRPL_BREAKER_RESET_SECONDS)
+
+
+def _http_error():
+    import httpx
+    return httpx.HTTPError
+
+
+def ledger_call(timeout: float = None):
+    '''
+    Wraps a coroutine that talks to the ledger with a deadline and the circuit breaker.
+    Timeouts and transport errors count as failures, anything the ledger answered
+    (including rejected transactions) counts as a success.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def call(*args, **kwargs):
+            breaker.before_call()
+            try:
+                result = await asyncio.wait_for(fn(*args, **kwargs), timeout or XRPL_CALL_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                breaker.record_failure()
+                raise LedgerUnavailable(f"XRPL call {fn.__name__} timed out")
+            except (_http_error(), OSError) as e:
+                breaker.record_failure()
+                raise LedgerUnavailable(f"XRPL call {fn.__name__} failed: {e}") from e
+            except Exception:
+                breaker.record_success()
+                raise
+            breaker.record_success()
+            return result
+        return call
+    return decorator
+
+
+@ledger_call()
+async def _submit_and_wait(txn, client, wallet):
+    from xrpledger.subscriptions import submit_and_watch
+    return await submit_and_watch(txn, client, wallet)
+
+@ledger_call()
+async def _get_next_valid_seq_number(account_addr : str, client):
+    from xrpl.asyncio.account import get_next_valid_seq_number as async_get_next_valid_seq_number
+    return await async_get_next_valid_seq_number(account_addr, client)
+
+class SequenceAllocator:
+    '''
+    Hands out account sequence numbers to this worker's submissions, so batches
+    signed by the same account at the same time (two confirms, a confirm and the
+    expiry sweeper, an accept) never reuse a sequence.
+    The first reservation for an account asks the ledger, later ones count on from there.
+    After a failed submission the account is read from the ledger again, since
+    the failure may have left a gap, or another worker may have used the sequence.
+    '''
+    def __init__(self):
+        self.next_sequence = {}
+        self.locks = {}
+
+    async def reserve(self, account_addr: str, count: int, client) -> int:
+        '''
+        Reserves count consecutive sequences for the account, and returns the first.
+        '''
+        async with self.locks.setdefault(account_addr, asyncio.Lock()):
+            if account_addr not in self.next_sequence:
+                self.next_sequence[account_addr] = await _get_next_valid_seq_number(account_addr, client)
+            first = self.next_sequence[account_addr]
+            self.next_sequence[account_addr] = first + count
+            return first
+
+    def refresh(self, account_addr: str):
+        self.next_sequence.pop(account_addr, None)
+
+
+sequences = SequenceAllocator()
+
+@ledger_call()
+async def _request(request, client):
+    response = await client.request(request)
+    return response.is_successful(), response.result
+
+@ledger_call(XRPL_FAUCET_TIMEOUT_SECONDS)
 async def create_account():
+    from xrpl.clients import JsonRpcClient
+    from xrpl.asyncio.wallet import generate_faucet_wallet as async_generate_faucet_wallet
+
     JSON_RPC_URL = "https://s.altnet.rippletest.net:51234/"
     client = JsonRpcClient(JSON_RPC_URL)
 
@@ -23,6 +168,11 @@ async def create_account():
     return [account_num, account_addr]
 
 async def finish_contract(sequences : list, conditions : list, fulfillments : list, source_acc_num : str, num_contracts : int):
+    from xrpl.clients import JsonRpcClient
+    from xrpl.models import EscrowFinish
+    from xrpl.wallet import Wallet
+    from xrpl.constants import CryptoAlgorithm
+
     client = JsonRpcClient("https://s.altnet.rippletest.net:51234")
     '''
     If num_contracts == 0, it means that we are cancelling the collateral because the courier 
@@ -38,7 +188,8 @@ async def finish_contract(sequences : list, conditions : list, fulfillments : li
 
         finish_txn = EscrowFinish(account=source_addr, owner=source_addr, offer_sequence=sequence, condition=condition, fulfillment=fulfillment)
 
-        txn_response = await async_submit_and_wait(finish_txn, client, sender_wallet)
+        # each submission gets its own deadline
+        txn_response = await _submit_and_wait(finish_txn, client, sender_wallet)
 
         stxn_result = txn_response.result
 
@@ -49,6 +200,13 @@ async def create_escrow(
         is_collateral_escrow: bool, 
         expire_time=datetime.now() + timedelta(days=5)
     ):
+    from xrpl.clients import JsonRpcClient
+    from xrpl.models import EscrowCreate
+    from xrpl.wallet import Wallet
+    from xrpl.constants import CryptoAlgorithm
+    from xrpl.utils import datetime_to_ripple_time, xrp_to_drops
+    from cryptoconditions import PreimageSha256
+
     client = JsonRpcClient("https://s.altnet.rippletest.net:51234") # Connect to client
     sequences = []
     conditions = []
@@ -93,7 +251,15 @@ async def create_escrow(
                 cancel_after=expiry_date,
                 condition=condition)
 
-        txn_response = await async_submit_and_wait(create_txn, client, sender_wallet)
+        # each submission gets its own deadline
+        try:
+            sequence = await sequences.reserve(source_addr, 1, client)
+            txn_response = await _submit_and_wait(replace(create_txn, sequence=sequence), client, sender_wallet)
+        except Exception as e:
+            sequences.refresh(source_addr)
+            raise EscrowCreateFailed(
+                e, [sequences, conditions[:len(sequences)], fulfillments[:len(sequences)]]
+            ) from e
 
         txn_result = txn_response.result
 
@@ -102,6 +268,11 @@ async def create_escrow(
     return [sequences, conditions, fulfillments]
 
 async def delete_escrow(source_acc_num: str, sequence: int):
+    from xrpl.clients import JsonRpcClient
+    from xrpl.models import EscrowCancel
+    from xrpl.wallet import Wallet
+    from xrpl.constants import CryptoAlgorithm
+
     client = JsonRpcClient("https://s.altnet.rippletest.net:51234") # Connect to client
 
     sender_wallet = Wallet.from_seed(seed=source_acc_num, algorithm=CryptoAlgorithm.ED25519)
@@ -109,10 +280,155 @@ async def delete_escrow(source_acc_num: str, sequence: int):
 
     cancel_txn = EscrowCancel(account=source_addr, owner=source_addr, offer_sequence=sequence)
 
-    stxn_response = await async_submit_and_wait(cancel_txn, client, sender_wallet)
+    stxn_response = await _submit_and_wait(cancel_txn, client, sender_wallet)
+
+async def submit_escrow_batch(actions : list):
+    '''
+    Submits a batch of escrow finishes / cancels concurrently.
+    Each action is a dict with the keys:
+        seed        - wallet seed of the escrow owner, who signs the transaction
+        action      - "finish" or "cancel"
+        sequence    - offer sequence of the escrow
+        condition   - escrow condition (finish only)
+        fulfillment - escrow fulfillment (finish only)
+    Sequence numbers come from the per-account allocator, so every transaction
+    can be in flight at once instead of waiting for a ledger close each.
+    Each submission has its own deadline and goes through the circuit breaker.
+    Returns a list of (succeeded, result) tuples in the same order as actions,
+    where result is the transaction result or the exception that was raised.
+    Nothing is raised, an action that could not be signed or submitted fails on its own.
+    '''
+    from xrpl.clients import JsonRpcClient
+    from xrpl.models import EscrowFinish, EscrowCancel
+    from xrpl.wallet import Wallet
+    from xrpl.constants import CryptoAlgorithm
+
+    client = JsonRpcClient("https://s.altnet.rippletest.net:51234")
+
+    results = [None] * len(actions)
+    wallets = {}
+    txns = {}
+    for idx, action in enumerate(actions):
+        try:
+            if action["seed"] not in wallets:
+                wallets[action["seed"]] = Wallet.from_seed(seed=action["seed"], algorithm=CryptoAlgorithm.ED25519)
+            source_addr = wallets[action["seed"]].address
+            if action["action"] == "finish":
+                txn = EscrowFinish(
+                    account=source_addr,
+                    owner=source_addr,
+                    offer_sequence=int(action["sequence"]),
+                    condition=action["condition"],
+                    fulfillment=action["fulfillment"])
+            else:
+                txn = EscrowCancel(
+                    account=source_addr,
+                    owner=source_addr,
+                    offer_sequence=int(action["sequence"]))
+        except Exception as e:
+            results[idx] = (False, e)
+            continue
+        txns.setdefault(action["seed"], []).append((idx, txn))
+
+    # one reservation per signing account, for every transaction it signs
+    first_sequences = await asyncio.gather(*[
+        sequences.reserve(wallets[seed].address, len(account_txns), client) for seed, account_txns in txns.items()
+    ], return_exceptions=True)
 
+    submissions = []
+    for (seed, account_txns), first_sequence in zip(txns.items(), first_sequences):
+        for offset, (idx, txn) in enumerate(account_txns):
+            if isinstance(first_sequence, Exception):
+                results[idx] = (False, first_sequence)
+            else:
+                submissions.append((idx, seed, _submit_and_wait(
+                    replace(txn, sequence=first_sequence + offset), client, wallets[seed]
+                )))
+
+    responses = await asyncio.gather(*[submission for _, _, submission in submissions], return_exceptions=True)
+
+    for (idx, seed, _), txn_response in zip(submissions, responses):
+        if isinstance(txn_response, Exception):
+            sequences.refresh(wallets[seed].address)
+            results[idx] = (False, txn_response)
+        else:
+            results[idx] = (True, txn_response.result)
+    return results
+
+@ledger_call()
 async def check_balance(account_addr : str):
+    from xrpl.clients import JsonRpcClient
+    from xrpl.asyncio.account import get_balance as async_get_balance
+
     client = JsonRpcClient("https://s.altnet.rippletest.net:51234")
     return await async_get_balance(address=account_addr, client=client, ledger_index="validated")
 
+async def _account_escrows(account_addr: str, client) -> list:
+    from xrpl.models.requests import AccountObjects, AccountObjectType
+
+    escrows = []
+    marker = None
+    while True:
+        succeeded, result = await _request(AccountObjects(
+            account=account_addr,
+            type=AccountObjectType.ESCROW,
+            ledger_index="validated",
+            limit=XRPL_PAGE_SIZE,
+            marker=marker), client)
+        if not succeeded:
+            if result.get("error") == "actNotFound":
+                return []
+            raise RuntimeError(f"account_objects failed for {account_addr}: {result.get('error')}")
+        escrows.extend(result["account_objects"])
+        marker = result.get("marker")
+        if marker is None:
+            return escrows
+
+async def fetch_escrows(account_addrs: list) -> dict:
+    '''
+    Returns {account address: [escrow ledger objects owned by the account]},
+    paging through account_objects for every account concurrently.
+    '''
+    from xrpl.asyncio.clients import AsyncJsonRpcClient
+
+    client = AsyncJsonRpcClient("https://s.altnet.rippletest.net:51234")
+    escrows = await asyncio.gather(*[_account_escrows(addr, client) for addr in account_addrs])
+    return dict(zip(account_addrs, escrows))
+
+async def fetch_escrow_settlements(account_addr: str, sequences: set, max_pages: int) -> dict:
+    '''
+    Walks the account's transaction history newest first, until every escrow
+    sequence is accounted for or max_pages pages have been read.
+    Returns {offer sequence: "finish" / "cancel"} for escrows owned by the account
+    that were successfully finished or cancelled.
+    '''
+    from xrpl.asyncio.clients import AsyncJsonRpcClient
+    from xrpl.models.requests import AccountTx
+
+    client = AsyncJsonRpcClient("https://s.altnet.rippletest.net:51234")
+    settlements = {}
+    marker = None
+    for _ in range(max_pages):
+        succeeded, result = await _request(AccountTx(
+            account=account_addr,
+            ledger_index_min=-1,
+            ledger_index_max=-1,
+            limit=XRPL_PAGE_SIZE,
+            marker=marker), client)
+        if not succeeded:
+            raise RuntimeError(f"account_tx failed for {account_addr}: {result.get('error')}")
+
+        for entry in result["transactions"]:
+            txn = entry.get("tx_json") or entry.get("tx") or {}
+            meta = entry.get("meta") or {}
+            if meta.get("TransactionResult") != "tesSUCCESS" or txn.get("Owner") != account_addr:
+                continue
+            if txn.get("TransactionType") == "EscrowFinish":
+                settlements[int(txn["OfferSequence"])] = "finish"
+            elif txn.get("TransactionType") == "EscrowCancel":
+                settlements[int(txn["OfferSequence"])] = "cancel"
 
+        marker = result.get("marker")
+        if marker is None or sequences <= settlements.keys():
+            break
+    return settlements
@@ -0,0 +1,219 @@
+'''
+Shared ledger WebSocket subscription, for waiting on submitted transactions.
+
+submit_and_wait polls the JSON-RPC endpoint for every transaction until it
+validates. Instead, each process keeps one WebSocket connection subscribed to the
+accounts it has transactions pending for, and resolves a future per transaction
+hash when the validated transaction comes through the stream. Any number of
+pending transactions cost one connection and no polling.
+
+The connection is also subscribed to the ledger stream: once a ledger past a
+transaction's LastLedgerSequence closes, the transaction can never validate, and
+its waiter fails straight away as a rejected transaction rather than running
+into the call deadline (which would count as a ledger outage).
+
+If the connection can't be opened, or drops while a transaction is pending, the
+transaction falls back to submit_and_wait. Resubmitting the same signed blob is
+safe: it has the same hash, so it can only be applied once.
+'''
+import asyncio
+import os
+
+XRPL_WS_URL = os.getenv("XRPL_WS_URL", "wss://s.altnet.rippletest.net:51233")
+# set to 0 to go back to polling for every transaction
+XRPL_USE_WEBSOCKET = os.getenv("XRPL_USE_WEBSOCKET", "1") == "1"
+
+
+class SubscriptionLost(Exception):
+    '''
+    Raised to pending transactions when the subscription connection drops.
+    '''
+
+
+class TransactionExpired(Exception):
+    '''
+    Raised to a pending transaction once a ledger past its LastLedgerSequence has closed.
+    '''
+
+
+class LedgerSubscriptions:
+    '''
+    One WebSocket connection per process, subscribed to the accounts that have
+    transactions pending. Accounts are unsubscribed once nothing is pending for them.
+    '''
+    def __init__(self, url: str):
+        self.url = url
+        self.client = None
+        self.reader = None
+        # hash -> (account, future)
+        self.pending = {}
+        # hash -> LastLedgerSequence, for transactions that have one
+        self.last_ledgers = {}
+        # account -> number of pending transactions
+        self.accounts = {}
+        # account -> task for its subscribe request, awaited by everyone watching the account
+        self.subscribed = {}
+        self.connecting = asyncio.Lock()
+
+    async def _connect(self):
+        from xrpl.asyncio.clients import AsyncWebsocketClient
+        from xrpl.models.requests import Subscribe, StreamParameter
+
+        async with self.connecting:
+            if self.client is not None and self.client.is_open():
+                return
+            client = AsyncWebsocketClient(self.url)
+            await client.open()
+            self.client = client
+            self.reader = asyncio.create_task(self._read(client))
+            # ledger closes, to expire transactions past their LastLedgerSequence
+            await client.request(Subscribe(streams=[StreamParameter.LEDGER]))
+
+    async def _read(self, client):
+        try:
+            async for message in client:
+                self._on_message(message)
+        except Exception as e:
+            print(f"Ledger subscription dropped: {e}")
+        finally:
+            if self.client is client:
+                self.client = None
+                self.accounts = {}
+                self.subscribed = {}
+                self.last_ledgers = {}
+                # nothing will resolve these any more, hand them back to polling
+                pending, self.pending = self.pending, {}
+                for _, future in pending.values():
+                    if not future.done():
+                        future.set_exception(SubscriptionLost("Ledger subscription dropped"))
+
+    def _on_message(self, message: dict):
+        if message.get("type") == "ledgerClosed":
+            self._expire(message["ledger_index"])
+            return
+        if message.get("type") != "transaction" or not message.get("validated"):
+            return
+        txn = message.get("tx_json") or message.get("transaction") or {}
+        tx_hash = message.get("hash") or txn.get("hash")
+        entry = self.pending.get(tx_hash)
+        if entry is None:
+            return
+        _, future = entry
+        if not future.done():
+            future.set_result({
+                "hash": tx_hash,
+                "tx_json": txn,
+                "meta": message.get("meta", {}),
+                "ledger_index": message.get("ledger_index"),
+                "validated": True,
+            })
+
+    def _expire(self, ledger_index: int):
+        # validated transactions come through before their ledger's close, so a
+        # transaction still pending after a ledger past its last one has closed never made it
+        for tx_hash, last_ledger in list(self.last_ledgers.items()):
+            if ledger_index > last_ledger:
+                del self.last_ledgers[tx_hash]
+                _, future = self.pending.get(tx_hash, (None, None))
+                if future is not None and not future.done():
+                    future.set_exception(TransactionExpired(
+                        f"Transaction {tx_hash} was not validated by its LastLedgerSequence {last_ledger}"
+                    ))
+
+    async def watch(self, tx_hash: str, account: str, last_ledger: int = None) -> asyncio.Future:
+        '''
+        Returns a future that resolves with the validated transaction, or fails
+        with TransactionExpired once a ledger past last_ledger closes.
+        Call before submitting, so the validation can't be missed.
+        '''
+        from xrpl.models.requests import Subscribe
+
+        await self._connect()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tx_hash] = (account, future)
+        if last_ledger is not None:
+            self.last_ledgers[tx_hash] = last_ledger
+        self.accounts[account] = self.accounts.get(account, 0) + 1
+        if account not in self.subscribed:
+            self.subscribed[account] = asyncio.create_task(
+                self.client.request(Subscribe(accounts=[account]))
+            )
+        try:
+            await asyncio.shield(self.subscribed[account])
+        except Exception:
+            self.subscribed.pop(account, None)
+            self.release(tx_hash)
+            raise
+        return future
+
+    def release(self, tx_hash: str):
+        '''
+        Stops watching a transaction, and unsubscribes its account if nothing else is pending on it.
+        '''
+        entry = self.pending.pop(tx_hash, None)
+        self.last_ledgers.pop(tx_hash, None)
+        if entry is None:
+            return
+        account, _ = entry
+        count = self.accounts.get(account, 0) - 1
+        if count > 0:
+            self.accounts[account] = count
+            return
+        self.accounts.pop(account, None)
+        if self.subscribed.pop(account, None) and self.client is not None and self.client.is_open():
+            from xrpl.models.requests import Unsubscribe
+            asyncio.create_task(self._unsubscribe(Unsubscribe(accounts=[account])))
+
+    async def _unsubscribe(self, request):
+        try:
+            await self.client.request(request)
+        except Exception as e:
+            print(f"Could not unsubscribe from ledger account: {e}")
+
+
+subscriptions = LedgerSubscriptions(XRPL_WS_URL)
+
+
+async def submit_and_watch(txn, client, wallet):
+    '''
+    Drop-in for submit_and_wait: signs and submits txn, then waits for it to
+    validate through the shared subscription instead of polling.
+    Returns the validated transaction response, raises XRPLReliableSubmissionException if it failed.
+    '''
+    from xrpl.asyncio.transaction import (
+        autofill_and_sign, submit, submit_and_wait, XRPLReliableSubmissionException
+    )
+    from xrpl.models.response import Response, ResponseStatus
+
+    signed = await autofill_and_sign(txn, client, wallet)
+    if not XRPL_USE_WEBSOCKET:
+        return await submit_and_wait(signed, client)
+
+    tx_hash = signed.get_hash()
+    try:
+        validated = await subscriptions.watch(tx_hash, signed.account, signed.last_ledger_sequence)
+    except Exception as e:
+        print(f"Ledger subscription unavailable, polling instead: {e}")
+        return await submit_and_wait(signed, client)
+
+    try:
+        prelim = await submit(signed, client)
+        engine_result = prelim.result["engine_result"]
+        if engine_result[0:3] in ("tem", "tef", "tel"):
+            raise XRPLReliableSubmissionException(
+                f"{engine_result}: {prelim.result.get('engine_result_message')}"
+            )
+        try:
+            result = await validated
+        except SubscriptionLost:
+            return await submit_and_wait(signed, client)
+        except TransactionExpired as e:
+            # the ledger answered, it just never took the transaction
+            raise XRPLReliableSubmissionException(str(e)) from e
+    finally:
+        subscriptions.release(tx_hash)
+
+    return_code = result["meta"].get("TransactionResult")
+    if return_code != "tesSUCCESS":
+        raise XRPLReliableSubmissionException(f"Transaction failed: {return_code}")
+    return Response(status=ResponseStatus.SUCCESS, result=result)